@@ -0,0 +1,414 @@
+#!/usr/bin/python
+
+"""
+Throughput benchmark of gdoc2nb conversion stages
+
+Generates a synthetic corpus of GRASS GIS manual-like pages (seeded,
+so the same corpus is generated every time), times the individual
+conversion stages and full conversion for each output language,
+stores the results as JSON and optionally compares them with a stored
+baseline.
+
+Usage::
+
+    python benchmark.py --output results.json
+    python benchmark.py --baseline benchmark_baseline.json
+    python benchmark.py --save-baseline benchmark_baseline.json
+
+(C) 2016-2020 by Vaclav Petras
+
+This program is free software under the GNU General Public License
+(>=v2). Read the file LICENSE for details.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import timeit
+
+import gdoc2nb
+
+LANGUAGES = ["python", "python2", "bash", "bash-cells", "pure-bash"]
+
+RASTERS = ["elevation", "slope", "aspect", "landuse", "soils", "streams_derived"]
+VECTORS = ["roads", "streams", "schools", "boundary_county", "zipcodes"]
+WORDS = (
+    "the module computes raster map from input elevation with given resolution"
+    " and region settings where each cell value is derived using neighborhood"
+    " analysis this example shows how to set computational region first"
+).split()
+
+# commands as templates to be filled with map names
+COMMANDS = [
+    "g.region raster={raster}",
+    "g.region raster={raster} -p",
+    "g.region vector={vector} res=10 -ap",
+    "r.info {raster}",
+    "r.univar {raster}",
+    "r.slope.aspect elevation={raster} slope=slope aspect=aspect",
+    "r.neighbors input={raster} output={raster}_smooth size=5",
+    'r.mapcalc "{raster}_ft = {raster} * 3.28"',
+    "r.stats {raster} -c",
+    "r.colors map={raster} color=elevation",
+    "r.watershed elevation={raster} accumulation=flowacc threshold=5000",
+    "v.info {vector}",
+    "v.buffer input={vector} output={vector}_buffer distance=100",
+    "v.to.rast input={vector} output={vector} use=attr attribute_column=cat",
+    "r.category {raster}",
+    "r.report {raster} units=h,c",
+    "r.neighbors input={raster} \\\n  output={raster}_avg size=7 \\\n  method=average",
+]
+DISPLAY = [
+    "d.erase",
+    "d.rast {raster}",
+    "d.vect {vector} color=red",
+    "d.legend {raster} at=5,50,2,6",
+    "d.barscale",
+]
+
+
+def generate_text(rng, n_words):
+    words = [rng.choice(WORDS) for i in range(n_words)]
+    words[0] = words[0].capitalize()
+    for i in range(rng.randint(0, 3)):
+        j = rng.randrange(len(words))
+        words[j] = "<em>%s</em>" % rng.choice(["r.mapcalc", "g.region", "d.rast"])
+    if rng.random() < 0.3:
+        words.append('see <a href="data/%s.txt">data</a>' % rng.choice(RASTERS))
+    if rng.random() < 0.2:
+        words.append("with &lt;value&gt; &amp; &ndash; more")
+    return "<p>\n%s.\n</p>" % " ".join(words)
+
+
+def generate_commands(rng, templates, n):
+    commands = []
+    for i in range(n):
+        command = rng.choice(templates).format(
+            raster=rng.choice(RASTERS), vector=rng.choice(VECTORS)
+        )
+        commands.append(command)
+    return commands
+
+
+def generate_code_block(rng):
+    lines = generate_commands(rng, COMMANDS, rng.randint(1, 6))
+    if rng.random() < 0.4:
+        lines.extend(generate_commands(rng, DISPLAY, rng.randint(1, 4)))
+        if rng.random() < 0.3:
+            lines.append("d.out.file map_%d" % rng.randint(1, 100))
+    if rng.random() < 0.2:
+        lines.insert(rng.randrange(len(lines) + 1), "<!-- d.erase -->")
+    return "<pre><code>\n%s\n</code></pre>" % "\n".join(lines)
+
+
+def generate_page(rng, n_sections=10):
+    """Generate one HTML page similar to a GRASS GIS manual page"""
+    parts = ["<h2>DESCRIPTION</h2>", generate_text(rng, 60)]
+    parts.append("<pre><code>\ngrass\n</code></pre>")
+    for i in range(n_sections):
+        parts.append("<h3>Example %d</h3>" % (i + 1))
+        parts.append(generate_text(rng, rng.randint(10, 80)))
+        kind = rng.random()
+        if kind < 0.6:
+            parts.append(generate_code_block(rng))
+        elif kind < 0.7:
+            values = [
+                "%d %s" % (value, rng.choice(["blue", "aqua", "green"]))
+                for value in (0, 50, 100)
+            ]
+            parts.append(
+                '<pre data-filename="colors_%d.txt">\n%s\n</pre>'
+                % (i, "\n".join(values))
+            )
+        elif kind < 0.8:
+            parts.append('<pre data-run="no"><code>\nd.mon wx0\n</code></pre>')
+        elif kind < 0.9:
+            parts.append("<!--\n%s\n-->" % generate_code_block(rng))
+        else:
+            items = "\n".join("<li>%s</li>" % rng.choice(WORDS) for i in range(4))
+            parts.append("<ul>\n%s\n</ul>" % items)
+    parts.append("<h2>SEE ALSO</h2>")
+    parts.append(generate_text(rng, 20))
+    return "\n\n".join(parts) + "\n"
+
+
+def generate_corpus(seed=42, n_pages=50, n_sections=10):
+    rng = random.Random(seed)
+    return [generate_page(rng, n_sections) for i in range(n_pages)]
+
+
+def conversion_args(lang):
+    return argparse.Namespace(
+        lang=lang,
+        grass="grass",
+        gisdbase="/grassdata",
+        location="nc_spm_08",
+        mapset="user1",
+        code_start=gdoc2nb.DEFAULT_CODE_START,
+        code_end=gdoc2nb.DEFAULT_CODE_END,
+        session_after_text=False,
+    )
+
+
+def best_time(function, repeat):
+    """Minimum of *repeat* runs in seconds (least disturbed by other load)"""
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def import_time(repeat):
+    """Minimum of cumulative times of importing gdoc2nb in a new interpreter
+
+    The module is imported once more before, so that the bytecode cache
+    is used as with an installed tool.
+    """
+    env = os.environ.copy()
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [sys.executable, "-X", "importtime", "-c", "import gdoc2nb"]
+    directory = os.path.dirname(os.path.abspath(gdoc2nb.__file__))
+    times = []
+    for i in range(repeat + 1):
+        result = subprocess.run(
+            command,
+            cwd=directory,
+            env=env,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if line.endswith("| gdoc2nb"):
+                times.append(int(line.split("|")[1]) / 1e6)
+    return min(times[1:])
+
+
+def stage_result(seconds, items, unit):
+    return {
+        "seconds": seconds,
+        "items": items,
+        "unit": unit,
+        "us_per_item": seconds / items * 1e6 if items else 0,
+    }
+
+
+def split_corpus(corpus):
+    blocks = []
+    for page in corpus:
+        processor = gdoc2nb.Processor()
+        splitter = gdoc2nb.Splitter(processor)
+        splitter.split(page)
+        processor.finish()
+        blocks.extend(processor.blocks)
+    return blocks
+
+
+def code_commands(blocks):
+    """Get commands from code blocks with continued lines joined"""
+    commands = []
+    continued_lines = []
+    for block in blocks:
+        if block["block_type"] != "code":
+            continue
+        text = gdoc2nb.code_block_to_text("\n".join(block["content"]))
+        for line in text.splitlines():
+            if line.endswith("\\"):
+                continued_lines.append(line)
+                continue
+            continued_lines.append(line)
+            command = "\n".join(continued_lines)
+            continued_lines = []
+            if command != "grass" and not command.startswith("<"):
+                commands.append(command)
+    return commands
+
+
+def run_benchmarks(corpus, repeat=5):
+    """Time all stages over the corpus and return results as a dictionary
+
+    Each stage reports total seconds and time per item (in microseconds)
+    where item is the unit the stage works on.
+    """
+    results = {}
+
+    def record(name, seconds, items, unit):
+        results[name] = stage_result(seconds, items, unit)
+
+    record("startup", import_time(repeat), 1, "import")
+
+    n_lines = sum(page.count("\n") for page in corpus)
+    record("split", best_time(lambda: split_corpus(corpus), repeat), n_lines, "line")
+
+    blocks = split_corpus(corpus)
+    commands = code_commands(blocks)
+
+    def parse():
+        # measure parsing itself, not the cache
+        gdoc2nb.string_to_module.cache_clear()
+        for command in commands:
+            gdoc2nb.string_to_module(command)
+
+    record("string_to_module", best_time(parse, repeat), len(commands), "command")
+    modules = [gdoc2nb.string_to_module(command) for command in commands]
+
+    def to_python():
+        for module in modules:
+            gdoc2nb.module_to_python(module)
+
+    record("module_to_python", best_time(to_python, repeat), len(modules), "command")
+
+    text_blocks = ["\n".join(b["content"]) for b in blocks if b["block_type"] == "text"]
+
+    def markdown():
+        notebook = gdoc2nb.nb.new_notebook()
+        for text in text_blocks:
+            converter = gdoc2nb.HTMLToMarkdownNotebookConverter(notebook)
+            converter.feed(text)
+            converter.finish()
+
+    record("markdown", best_time(markdown, repeat), len(text_blocks), "block")
+
+    notebooks = {}
+    for lang in LANGUAGES:
+        args = conversion_args(lang)
+
+        def convert():
+            gdoc2nb.string_to_module.cache_clear()
+            notebooks[lang] = [gdoc2nb.convert(page, args) for page in corpus]
+
+        record("convert_%s" % lang, best_time(convert, repeat), len(corpus), "page")
+
+    args = conversion_args(",".join(LANGUAGES))
+
+    def convert_all():
+        gdoc2nb.string_to_module.cache_clear()
+        for page in corpus:
+            gdoc2nb.convert_languages(page, args)
+
+    record("convert_all_languages", best_time(convert_all, repeat), len(corpus), "page")
+
+    def write():
+        for notebook in notebooks["python"]:
+            gdoc2nb.nbf.write(notebook, io.StringIO())
+
+    record("nbformat_write", best_time(write, repeat), len(corpus), "page")
+    return results
+
+
+def compare(results, baseline, tolerance, stage_tolerances=None):
+    """Get list of stages slower than baseline by more than *tolerance*
+
+    The *stage_tolerances* dictionary can give a different tolerance
+    for some stages. Stages missing in the baseline are in the list with
+    None as the baseline time.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            regressions.append((name, None, result["us_per_item"]))
+            continue
+        reference = baseline[name]["us_per_item"]
+        current = result["us_per_item"]
+        limit = (stage_tolerances or {}).get(name, tolerance)
+        if reference and current > reference * (1 + limit):
+            regressions.append((name, reference, current))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark gdoc2nb on a synthetic GRASS GIS manual corpus."
+    )
+    parser.add_argument("--seed", type=int, default=42, help="Corpus random seed")
+    parser.add_argument("--pages", type=int, default=50, help="Number of pages")
+    parser.add_argument(
+        "--sections", type=int, default=10, help="Number of sections per page"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of runs of each stage"
+    )
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--baseline", help="Compare results with this JSON file")
+    parser.add_argument("--save-baseline", help="Write results as a new baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative slowdown against the baseline",
+    )
+    parser.add_argument(
+        "--startup-tolerance",
+        type=float,
+        default=1.0,
+        help="Allowed relative slowdown of the startup (import of the tool)"
+        " against the baseline (starting an interpreter is more noisy)",
+    )
+    parser.add_argument(
+        "--startup-only",
+        action="store_true",
+        help="Measure only the startup (a quick check of the startup target)",
+    )
+    args = parser.parse_args()
+    if args.startup_only and args.save_baseline:
+        parser.error("baseline needs all stages (use it without --startup-only)")
+
+    if args.startup_only:
+        stages = {"startup": stage_result(import_time(args.repeat), 1, "import")}
+    else:
+        corpus = generate_corpus(args.seed, args.pages, args.sections)
+        stages = run_benchmarks(corpus, repeat=args.repeat)
+    results = {
+        "metadata": {
+            "seed": args.seed,
+            "pages": args.pages,
+            "sections": args.sections,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "version": gdoc2nb.__version__,
+        },
+        "stages": stages,
+    }
+    for name, result in results["stages"].items():
+        print(
+            "%-20s %10.2f us/%s %8.3f s"
+            % (name, result["us_per_item"], result["unit"], result["seconds"])
+        )
+    for filename in (args.output, args.save_baseline):
+        if filename:
+            with open(filename, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+                f.write("\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(
+            results["stages"],
+            baseline["stages"],
+            args.tolerance,
+            {"startup": args.startup_tolerance},
+        )
+        failed = False
+        for name, reference, current in regressions:
+            if reference is None:
+                print(
+                    "Stage %s not in the baseline (save a new one)" % name,
+                    file=sys.stderr,
+                )
+                continue
+            failed = True
+            print(
+                "Regression in %s: %.2f us (baseline %.2f us)"
+                % (name, current, reference),
+                file=sys.stderr,
+            )
+        if failed:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
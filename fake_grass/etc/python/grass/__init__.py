@@ -0,0 +1 @@
+"""Stub of GRASS GIS Python package for testing notebooks (see fake_grass/grass)"""
@@ -0,0 +1,12 @@
+"""Exceptions of the stub GRASS GIS Python package"""
+
+
+class CalledModuleError(Exception):
+    """Raised when a module cannot run"""
+
+    def __init__(self, module, code, returncode, errors=None):
+        Exception.__init__(self, "Module %s failed: %s" % (module, errors or code))
+        self.module = module
+        self.code = code
+        self.returncode = returncode
+        self.errors = errors
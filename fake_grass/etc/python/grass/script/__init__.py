@@ -0,0 +1,140 @@
+"""
+Stub of grass.script for testing notebooks without GRASS GIS
+
+Modules are not run, each call is only checked and recorded (in file
+given by FAKE_GRASS_LOG variable if set). Display modules create the
+rendered file and the output of a module are its options as key=value
+lines, so that parse_command() gives a dictionary.
+"""
+
+import os
+import re
+import struct
+import sys
+import zlib
+
+from grass.exceptions import CalledModuleError
+
+_module_name = re.compile(r"^[a-z0-9]+\.[a-z0-9_.]+$")
+_raise_on_error = False
+_capture_stderr = False
+
+
+def set_raise_on_error(raise_exp=True):
+    global _raise_on_error
+    previous = _raise_on_error
+    _raise_on_error = raise_exp
+    return previous
+
+
+def set_capture_stderr(capture=True):
+    global _capture_stderr
+    previous = _capture_stderr
+    _capture_stderr = capture
+    return previous
+
+
+def _png():
+    """Get 1x1 white PNG image"""
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(b"\x00\xff"))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _run(module, flags="", **options):
+    """Record a module call and get its output"""
+    if not _module_name.match(module):
+        raise CalledModuleError(module, [module], 127, "module not found")
+    options = dict(
+        (key.rstrip("_"), value) for key, value in options.items() if value is not None
+    )
+    line = " ".join(
+        [module]
+        + (["-" + flags] if flags else [])
+        + ["%s=%s" % (key, value) for key, value in sorted(options.items())]
+    )
+    log = os.environ.get("FAKE_GRASS_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write(line + "\n")
+    if module.startswith("d.") and os.environ.get("GRASS_RENDER_IMMEDIATE"):
+        with open(os.environ.get("GRASS_RENDER_FILE", "map.png"), "wb") as f:
+            f.write(_png())
+    return "".join("%s=%s\n" % item for item in sorted(options.items()))
+
+
+def run_command(module, *args, **kwargs):
+    _run(module, *args, **kwargs)
+    return 0
+
+
+def read_command(module, *args, **kwargs):
+    return _run(module, *args, **kwargs)
+
+
+def write_command(module, *args, **kwargs):
+    kwargs.pop("stdin", None)
+    _run(module, *args, **kwargs)
+    return 0
+
+
+def parse_key_val(s, sep="=", val_type=None):
+    result = {}
+    for line in s.splitlines():
+        key, _, value = line.partition(sep)
+        result[key.strip()] = val_type(value) if val_type else value.strip()
+    return result
+
+
+def parse_command(module, *args, **kwargs):
+    parse = kwargs.pop("parse", None)
+    delimiter = kwargs.pop("delimiter", "=")
+    output = _run(module, *args, **kwargs)
+    if parse:
+        return parse[0](output, **parse[1])
+    return parse_key_val(output, sep=delimiter)
+
+
+def mapcalc(exp, quiet=False, verbose=False, overwrite=False, **kwargs):
+    _run("r.mapcalc", expression=exp)
+
+
+def mapcalc3d(exp, quiet=False, verbose=False, overwrite=False, **kwargs):
+    _run("r3.mapcalc", expression=exp)
+
+
+def region(**kwargs):
+    return {
+        "n": 228500.0,
+        "s": 215000.0,
+        "e": 645000.0,
+        "w": 630000.0,
+        "nsres": 10.0,
+        "ewres": 10.0,
+        "rows": 1350,
+        "cols": 1500,
+        "cells": 2025000,
+    }
+
+
+def message(msg, flag=None):
+    sys.stderr.write("%s\n" % msg)
+
+
+def warning(msg):
+    sys.stderr.write("WARNING: %s\n" % msg)
+
+
+def fatal(msg):
+    if _raise_on_error:
+        raise RuntimeError(msg)
+    sys.stderr.write("ERROR: %s\n" % msg)
+    sys.exit(1)
@@ -0,0 +1,17 @@
+"""Stub of grass.script.setup"""
+
+import os
+import tempfile
+
+
+def init(gisbase, dbase="", location="demolocation", mapset="PERMANENT"):
+    """Set session variables and write the rc file, return its path"""
+    os.environ["GISBASE"] = gisbase
+    fd, rcfile = tempfile.mkstemp(prefix="gisrc")
+    with os.fdopen(fd, "w") as f:
+        f.write("GISDBASE: %s\n" % dbase)
+        f.write("LOCATION_NAME: %s\n" % location)
+        f.write("MAPSET: %s\n" % mapset)
+        f.write("GUI: text\n")
+    os.environ["GISRC"] = rcfile
+    return rcfile
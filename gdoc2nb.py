@@ -9,21 +9,78 @@ This program is free software under the GNU General Public License
 (>=v2). Read the file LICENSE for details.
 """
 
-
-import nbformat as nbf
-from nbformat import v4 as nb
+import os
 import sys
 import argparse
+import collections
+import contextlib
+import functools
+import importlib
+import json
 from html.parser import HTMLParser
 from html.entities import name2codepoint
-import shlex
 import re
 import keyword
+import tempfile
+import time
+import uuid
+
+try:
+    import resource
+except ImportError:
+    # not available on MS Windows
+    resource = None
+
+
+class LazyModule(object):
+    """Module imported only when its attribute is accessed for the first time
+
+    The tool is often started for a single small file, so heavy imports
+    are deferred until they are needed (and skipped when not needed).
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, name)
+
+
+class LazyPattern(object):
+    """Regular expression compiled when it is used for the first time
+
+    After the first use, the methods of the compiled pattern are stored
+    as attributes of this object, so there is no overhead for later calls.
+
+    >>> p = LazyPattern(r"^d\.")
+    >>> bool(p.search("d.rast"))
+    True
+    """
+
+    def __init__(self, pattern, flags=0):
+        self._pattern = pattern
+        self._flags = flags
+
+    def __getattr__(self, name):
+        # called only for attributes not set yet
+        value = getattr(re.compile(self._pattern, self._flags), name)
+        setattr(self, name, value)
+        return value
+
+
+# nbformat imports jsonschema and others which is the most of startup time
+nbf = LazyModule("nbformat")
+nb = LazyModule("nbformat.v4")
+
+__version__ = "0.1.0"
 
 ignored_lines = [
     # re.compile(r'grass70'),
-    re.compile(r"cd"),
-    re.compile(r"cd.*"),
+    LazyPattern(r"cd"),
+    LazyPattern(r"cd.*"),
     # re.compile(r'\s*d\.mon'),
     # re.compile(r'\s*d\.out.file')
 ]
@@ -31,29 +88,29 @@ ignored_lines = [
 line_count = 0
 
 common_replacements = [
-    (re.compile("&gt;"), ">"),
-    (re.compile("&lt;"), "<"),
-    (re.compile("&amp;"), "&"),
+    (LazyPattern("&gt;"), ">"),
+    (LazyPattern("&lt;"), "<"),
+    (LazyPattern("&amp;"), "&"),
 ]
 
 # allow also uppper case tags for now
 text_replacemets = [
-    (re.compile(r"<p>", re.IGNORECASE), ""),
-    (re.compile(r"</p>", re.IGNORECASE), ""),
-    (re.compile(r"<br>", re.IGNORECASE), ""),
-    (re.compile(r"<div>", re.IGNORECASE), ""),
-    (re.compile(r"</div>", re.IGNORECASE), ""),
-    (re.compile(r'<a href="([^"]+)">[^<]+</a>', re.IGNORECASE), r"\1"),
-    (re.compile(r"^\s+\n$", re.IGNORECASE), "\n"),
+    (LazyPattern(r"<p>", re.IGNORECASE), ""),
+    (LazyPattern(r"</p>", re.IGNORECASE), ""),
+    (LazyPattern(r"<br>", re.IGNORECASE), ""),
+    (LazyPattern(r"<div>", re.IGNORECASE), ""),
+    (LazyPattern(r"</div>", re.IGNORECASE), ""),
+    (LazyPattern(r'<a href="([^"]+)">[^<]+</a>', re.IGNORECASE), r"\1"),
+    (LazyPattern(r"^\s+\n$", re.IGNORECASE), "\n"),
 ]
 
 text_replacemets.extend(common_replacements)
 
-file_path_extraction = re.compile(r'<a href="([^"]+)"[^>]*>([^<]+)</a>', re.IGNORECASE)
-file_from_url_extraction = re.compile(
+file_path_extraction = LazyPattern(r'<a href="([^"]+)"[^>]*>([^<]+)</a>', re.IGNORECASE)
+file_from_url_extraction = LazyPattern(
     r'<a href="([^"]+)/([^"/]+)"[^>]*>([^<]+)</a>', re.IGNORECASE
 )
-download_attribute_presence = re.compile(
+download_attribute_presence = LazyPattern(
     r'<a href="([^"]+)"[^>]* download[^>]*>([^<]+)</a>', re.IGNORECASE
 )
 
@@ -66,59 +123,395 @@ code_replacemets = [
 
 # code_replacemets.extend(common_replacements)
 
-d_command = re.compile(r"d\..+ .+")
+d_command = LazyPattern(r"d\..+ .+")
+
+
+class Profile(object):
+    """Wall time and number of calls of conversion stages and other counters
+
+    Time of a stage does not include time of stages nested in it, so the
+    stage times add up to the total time.
 
+    >>> p = Profile()
+    >>> with p.stage("split"):
+    ...     with p.stage("markdown"):
+    ...         p.count("blocks_text")
+    >>> p.stages["markdown"][1], p.counters["blocks_text"]
+    (1, 1)
+    """
 
-class Module(object):
     def __init__(self):
-        self.name = None
-        self.options = []  # as list to preserve order
-        self.flags = ""
-        self.long_flags = []
-        self.first_option = None
-        self.original_string = None
+        # name: [seconds, calls]
+        self.stages = {}
+        self.counters = collections.Counter()
+        self._stack = []
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            # pause the enclosing stage
+            self._add_time(self._stack[-1], now)
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self._add_time(self._stack.pop(), now)
+            record = self.stages.setdefault(name, [0.0, 0])
+            record[1] += 1
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def _add_time(self, item, now):
+        name, start = item
+        self.stages.setdefault(name, [0.0, 0])[0] += now - start
+        item[1] = now
+
+    def count(self, name, number=1):
+        self.counters[name] += number
+
+    def as_dict(self):
+        result = {
+            "total_seconds": time.perf_counter() - self._start,
+            "stages": {
+                name: {"seconds": seconds, "calls": calls}
+                for name, (seconds, calls) in sorted(self.stages.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+        }
+        if resource:
+            # kilobytes on Linux, whole process (not only this conversion,
+            # so it includes earlier inputs of the same process)
+            result["process_peak_memory_kb"] = resource.getrusage(
+                resource.RUSAGE_SELF
+            ).ru_maxrss
+        return result
+
+
+class NullProfile(object):
+    """Profile which does not record anything (used by default)"""
+
+    _null_context = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._null_context
+
+    def count(self, name, number=1):
+        pass
+
+
+# profile of the current conversion, replaced by Profile when requested
+profiler = NullProfile()
+
+
+class Module(
+    collections.namedtuple(
+        "Module",
+        [
+            "name",
+            "options",
+            "option_keys",
+            "flags",
+            "long_flags",
+            "first_option",
+            "original_string",
+        ],
+    )
+):
+    """Parsed module call (immutable, so it can be shared and cached)
+
+    The *options* are a tuple of (key, value) pairs to preserve order,
+    *option_keys* is a set of their keys for quick lookup.
+
+    >>> module = string_to_module("r.neighbors elevation output=smooth")
+    >>> module.uses_option("output"), module.uses_options(("input", "map"))
+    (True, False)
+    >>> resolved = module.with_first_option("input")
+    >>> resolved.options
+    (('input', 'elevation'), ('output', 'smooth'))
+    >>> resolved.uses_option("input"), module.uses_option("input")
+    (True, False)
+    """
+
+    __slots__ = ()
 
     def uses_option(self, name):
-        return name in [key for key, value in self.options]
+        return name in self.option_keys
 
     # TODO: implement AND and OR relation, now only OR
     def uses_options(self, names):
-        keys = [key for key, value in self.options]
-        for name in names:
-            if name in keys:
-                return True
-        return False
+        return not self.option_keys.isdisjoint(names)
+
+    def with_first_option(self, key):
+        """Get new module with first option value used as option *key*"""
+        return self._replace(
+            options=((key, self.first_option),) + self.options,
+            option_keys=self.option_keys | {key},
+            first_option=None,
+        )
 
 
-def string_to_module(string):
-    module = Module()
+# characters which need the full shell rules to split the command
+shell_syntax_characters = LazyPattern(r"[\"'\\]")
+simple_token = LazyPattern(r"[^ \t\r\n]+")
+option_token = LazyPattern(r"([a-z_0-9]+)=(.*)")
+flags_token = LazyPattern(r"-([a-zA-Z0-9]+)")
+long_flag_token = LazyPattern(r"--([a-zA-Z0-9_]+)")
+
+
+def split_command(string):
+    """Split command line to tokens using shell rules
+
+    Simple commands are split on whitespace, shlex is used only when there
+    are quotes or backslashes.
+
+    >>> split_command("g.region raster=elevation -p")
+    ['g.region', 'raster=elevation', '-p']
+    >>> split_command("r.mapcalc 'a = b'")
+    ['r.mapcalc', 'a = b']
+    """
+    if not shell_syntax_characters.search(string):
+        return simple_token.findall(string)
+    profiler.count("shlex_fallbacks")
+    from shlex import split as shlex_split
+
     try:
-        tokens = shlex.split(string)
+        return shlex_split(string)
     except ValueError as error:
         raise ValueError("Cannot parse using shell rules (%s): %s" % (error, string))
-    module.name = tokens[0]
-    module.original_string = string
-    for i, token in enumerate(tokens[1:]):
-        match = re.search("^([a-z_0-9]+)=(.*)", token)
+
+
+@functools.lru_cache(maxsize=4096)
+def string_to_module(string):
+    """Parse command line to a Module
+
+    The same commands repeat a lot, so the results are cached.
+
+    >>> module = string_to_module("r.slope.aspect elevation slope=slope -e")
+    >>> module.name, module.first_option, module.options, module.flags
+    ('r.slope.aspect', 'elevation', (('slope', 'slope'),), 'e')
+    >>> string_to_module("r.slope.aspect elevation slope=slope -e") is module
+    True
+    """
+    # not counted for the cached results
+    profiler.count("module_cache_misses")
+    tokens = split_command(string)
+    name = tokens[0]
+    options = []
+    flags = ""
+    long_flags = []
+    first_option = None
+    for token in tokens[1:]:
+        match = option_token.match(token)
         if match:
             key = match.group(1)
             value = match.group(2)
-            module.options.append((key, value))
+            options.append((key, value))
             continue
-        match = re.search("^-([a-zA-Z0-9]+)", token)
+        match = flags_token.match(token)
         if match:
             # flag or flags
-            flag = match.group(1)
-            module.flags += flag
+            flags += match.group(1)
             continue
-        match = re.search("^--([a-zA-Z0-9_]+)", token)
+        match = long_flag_token.match(token)
         if match:
-            flag = match.group(1)
-            module.long_flags.append(flag)
+            long_flags.append(match.group(1))
+            continue
+        if not options:
+            first_option = token
+    return Module(
+        name=name,
+        options=tuple(options),
+        option_keys=frozenset([key for key, value in options]),
+        flags=flags,
+        long_flags=tuple(long_flags),
+        first_option=first_option,
+        original_string=string,
+    )
+
+
+def module_interface(path):
+    """Get module name and its index entry from interface description XML
+
+    The XML file is the output of ``module --interface-description``.
+    The entry is a list with name of the first option (the one used for
+    a value without key), ``"parse"`` if the module only prints
+    information which it can print in shell script style (flag g) or
+    ``"run"`` otherwise, and lists of options with input and output
+    maps.
+    """
+    from xml.etree import ElementTree
+
+    task = ElementTree.parse(path).getroot()
+    parameters = task.findall("parameter")
+    first_key = parameters[0].get("name") if parameters else None
+    creates_output = False
+    map_inputs = []
+    map_outputs = []
+    for parameter in parameters:
+        prompt = parameter.find("gisprompt")
+        if prompt is None:
             continue
-        if not module.options:
-            module.first_option = token
-    return module
+        if prompt.get("age") == "new":
+            creates_output = True
+        if prompt.get("prompt") in MAP_PROMPTS:
+            if prompt.get("age") == "old":
+                map_inputs.append(parameter.get("name"))
+            elif prompt.get("age") == "new":
+                map_outputs.append(parameter.get("name"))
+    shell_style = False
+    for flag in task.findall("flag"):
+        if flag.get("name") == "g":
+            description = flag.findtext("description") or ""
+            shell_style = "shell" in description.lower()
+    behavior = "parse" if shell_style and not creates_output else "run"
+    return task.get("name"), [first_key, behavior, map_inputs, map_outputs]
+
+
+def build_module_index(directory):
+    """Create index of modules from interface description XML files
+
+    The *directory* contains one XML file for each module, e.g., created
+    by ``r.info --interface-description > r.info.xml``.
+    """
+    index = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".xml"):
+            module, entry = module_interface(os.path.join(directory, name))
+            index[module] = entry
+    return index
+
+
+def write_module_index(index, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"format": 2, "modules": index}, f, separators=(",", ":"), sort_keys=True
+        )
+
+
+def load_module_index(path):
+    """Load module index created by write_module_index
+
+    The index is loaded once per process and again only when the file
+    changes (e.g., is rebuilt while a server is running).
+    """
+    stat = os.stat(path)
+    return _load_module_index(path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_module_index(path, mtime, size):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["modules"]
+
+
+# types of data (gisprompt prompt in interface description) tracked as maps
+MAP_PROMPTS = ("raster", "raster_3d", "vector")
+
+# module name -> [first option, "parse" or "run", map inputs, map outputs]
+# (format 1 has only the first two), see use_module_index()
+module_index = {}
+
+
+def use_module_index(path):
+    """Use module index from *path* for the conversion (None for no index)"""
+    global module_index
+    module_index = load_module_index(path) if path else {}
+
+
+def first_option_key(module, index=None):
+    """Get key of the option given without key or None if unknown
+
+    Modules in the module *index* (the one in use by default) use the key
+    from the index, other modules the key guessed from the module name
+    and other options.
+
+    >>> module = string_to_module("r.slope.aspect elevation slope=slope")
+    >>> first_option_key(module, index={})
+    'map'
+    >>> first_option_key(module, index={"r.slope.aspect": ["elevation", "run"]})
+    'elevation'
+    """
+    if index is None:
+        index = module_index
+    if module.name in index:
+        return index[module.name][0]
+    # this is just guessing, only safe way is the fallback
+    if module.uses_options(("output", "out")):
+        return "input"
+    elif module.name == "g.region":
+        return "region"
+    elif module.name == "d.legend":
+        return "raster"
+    elif module.name == "r.stats":  # r.stats has optional output
+        return "input"
+    elif module.name.startswith(("d.", "r.", "v.")) and module.name not in [
+        "d.out.file"
+    ]:
+        return "map"
+    # elif module.name.startswith('d.'):
+    #    first_key = "map"
+    # elif module.name.startswith('r.'):
+    #    first_key = "input"
+    return None
+
+
+# options with input and output maps for modules not in the module index
+MAP_INPUT_OPTIONS = ("input", "map", "raster", "vector", "elevation")
+MAP_OUTPUT_OPTIONS = ("output", "out")
+
+# names in expression which are not function names or parts of numbers
+mapcalc_name = LazyPattern(r"(?<![\w.@])[A-Za-z_][\w.@]*(?![\w.@]|\s*\()")
+
+
+def map_names(value):
+    """Get map names from option value without mapsets"""
+    return [name.split("@")[0] for name in value.split(",") if name]
+
+
+def command_maps(module):
+    """Get sets of maps used (inputs) and created (outputs) by a module
+
+    Options are taken from the module index if the module is there,
+    otherwise common option names are used.
+
+    >>> command_maps(string_to_module("r.neighbors input=dem output=smooth"))
+    ({'dem'}, {'smooth'})
+    >>> command_maps(string_to_module("r.mapcalc 'ft = dem@PERMANENT * 3.28'"))
+    ({'dem'}, {'ft'})
+    """
+    inputs = set()
+    outputs = set()
+    if module.name in ("r.mapcalc", "r3.mapcalc"):
+        expression = module.first_option
+        if not expression:
+            expression = dict(module.options).get("expression", "")
+        if "=" in expression:
+            name, expression = expression.split("=", 1)
+            outputs.update(map_names(name.strip()))
+            for name in mapcalc_name.findall(expression):
+                inputs.update(map_names(name))
+        return inputs, outputs
+    entry = module_index.get(module.name)
+    if entry and len(entry) > 2:
+        input_keys, output_keys = entry[2], entry[3]
+    elif "." in module.name:
+        # GRASS GIS modules only
+        input_keys, output_keys = MAP_INPUT_OPTIONS, MAP_OUTPUT_OPTIONS
+    else:
+        return inputs, outputs
+    if module.first_option:
+        key = first_option_key(module)
+        if key:
+            module = module.with_first_option(key)
+    for key, value in module.options:
+        if key in input_keys:
+            inputs.update(map_names(value))
+        elif key in output_keys:
+            outputs.update(map_names(value))
+    return inputs, outputs
 
 
 def module_to_python(module):
@@ -127,37 +520,20 @@ def module_to_python(module):
         if module.name in ["r.mapcalc"]:
             first_option_usable = True
         else:
-            # this is just guessing, only safe way is the fallback
-            if module.uses_options(("output", "out")):
-                # TODO: do not modify function input
-                module.options.insert(0, ("input", module.first_option))
-            elif module.name == "g.region":
-                module.options.insert(0, ("region", module.first_option))
-            elif module.name == "d.legend":
-                module.options.insert(0, ("raster", module.first_option))
-            elif module.name == "r.stats":  # r.stats has optional output
-                module.options.insert(0, ("input", module.first_option))
-            elif module.name.startswith(("d.", "r.", "v.")) and module.name not in [
-                "d.out.file"
-            ]:
-                # TODO: do not modify function input
-                module.options.insert(0, ("map", module.first_option))
-            # elif module.name.startswith('d.'):
-            #    # TODO: do not modify function input
-            #    module.options.insert(0, ('map', module.first_option))
-            # elif module.name.startswith('r.'):
-            #    # TODO: do not modify function input
-            #    module.options.insert(0, ('input', module.first_option))
-            else:
+            first_key = first_option_key(module)
+            if not first_key:
+                profiler.count("manual_fallbacks")
                 return (
                     "# execute manually the following or its equivalent:\n# %s"
                     % module.original_string
                 )
+            module = module.with_first_option(first_key)
 
+    flags = module.flags
     is_reading = False
     if (
         module.name in ["r.category", "r.report"]
-        or (module.name == "v.info" and "g" not in module.flags)
+        or (module.name == "v.info" and "g" not in flags)
         or (module.name == "r.stats" and not module.uses_option("output"))
     ):
         is_reading = True
@@ -173,12 +549,15 @@ def module_to_python(module):
         string = "gs.mapcalc(%s%s%s" % (quote, value, quote)
     elif (
         module.name in ["r.info", "r.univar", "v.univar"]
-        or (module.name == "v.info" and "c" not in module.flags)
-        or (module.name == "g.region" and ("p" in module.flags or "g" in module.flags))
+        or (module.name == "v.info" and "c" not in flags)
+        or (module.name == "g.region" and ("p" in flags or "g" in flags))
+        or (
+            module.name not in ["v.info", "g.region"]
+            and module_index.get(module.name, [None, "run"])[1] == "parse"
+        )
     ):
-        if "g" not in module.flags:
-            # TODO: do not modify function input
-            module.flags += "g"
+        if "g" not in flags:
+            flags += "g"
         string = "gs.parse_command('%s'" % module.name
     elif is_reading:
         string = "print(gs.read_command('%s'" % module.name
@@ -196,8 +575,8 @@ def module_to_python(module):
             key += "_"
         string += ", %s=%s%s%s" % (key, quote, value, quote)
 
-    if module.flags:
-        string += ", flags='%s'" % module.flags
+    if flags:
+        string += ", flags='%s'" % flags
 
     for flag in module.long_flags:
         string += ", %s=True" % (flag)
@@ -257,6 +636,50 @@ os.environ['GRASS_LEGEND_FILE'] = 'legend.txt'
 """
 # gs.run_command('d.mon', start='cairo')
 
+GRASS_END_CODE = """\
+# end the GRASS session
+os.remove(rcfile)
+"""
+
+# session code for Bash scripts (the notebooks use Python for it)
+BASH_GRASS_START_CODE = """\
+# create GRASS GIS runtime environment
+GISBASE=$("{grass}" --config path)
+export GISBASE
+export PATH="$GISBASE/bin:$GISBASE/scripts:$PATH"
+export LD_LIBRARY_PATH="$GISBASE/lib:$LD_LIBRARY_PATH"
+export PYTHONPATH="$GISBASE/etc/python:$PYTHONPATH"
+
+# set GRASS GIS session data
+GISRC=$(mktemp)
+export GISRC
+cat > "$GISRC" << EOF
+GISDBASE: {gisdbase}
+LOCATION_NAME: {location}
+MAPSET: {mapset}
+GUI: text
+EOF
+"""
+
+BASH_GRASS_SETTINGS_CODE = """\
+# default font displays
+export GRASS_FONT=sans
+# overwrite existing maps
+export GRASS_OVERWRITE=1
+"""
+
+BASH_GRASS_START_DISPLAY_CODE = """\
+# set display modules to render into a file (named map.png by default)
+export GRASS_RENDER_IMMEDIATE=cairo
+export GRASS_RENDER_FILE_READ=TRUE
+export GRASS_LEGEND_FILE=legend.txt
+"""
+
+BASH_GRASS_END_CODE = """\
+# end the GRASS session
+rm "$GISRC"
+"""
+
 
 def start_of_grass_session(string, grass, gisdbase, location, mapset, python2=False):
     if python2:
@@ -277,72 +700,174 @@ def start_of_grass_session(string, grass, gisdbase, location, mapset, python2=Fa
     ]
 
 
-# TODO: refactor the following 4 functions
-def bash_to_python(string):
-    output = []
-    prev_line = ""
-    d_command_present = False
-    last_command = None
+class Command(object):
+    """One command (possibly from continued lines) of a code block
+
+    The command line is parsed to a Module only when needed and only once.
+    """
+
+    __slots__ = ("line", "_module")
+
+    def __init__(self, line):
+        self.line = line
+        self._module = None
+
+    @property
+    def module(self):
+        if self._module is None:
+            with profiler.stage("parse"):
+                self._module = string_to_module(self.line)
+        return self._module
+
+
+def parse_code_block(string):
+    r"""Split code to commands joining lines continued by backslash
+
+    Empty lines are represented by None.
+
+    >>> [c and c.line for c in parse_code_block("g.region \\\n -p\n\nd.erase")]
+    ['g.region \\\n -p', None, 'd.erase']
+    """
+    commands = []
+    continued_lines = []
     for line in string.splitlines():
         if line:
             if line.endswith("\\"):
-                prev_line += line + "\n"
+                continued_lines.append(line)
                 continue
-            elif prev_line:
-                line = prev_line + line
-                prev_line = ""
-            module = string_to_module(line)
-            # TODO: potentially split to cells when d.out.file
-            if module.name == "d.out.file":
-                output.append('Image(filename="map.png")')
-            else:
-                output.append(module_to_python(module))
-                if module.name.startswith("d."):
-                    d_command_present = True
-            last_command = module.name
+            elif continued_lines:
+                continued_lines.append(line)
+                line = "\n".join(continued_lines)
+                continued_lines = []
+            commands.append(Command(line))
         else:
-            output.append("\n")
-    if d_command_present and last_command != "d.out.file":
-        output.append('Image(filename="map.png")')
-    return ["\n".join(output)]
+            commands.append(None)
+    profiler.count("commands_parsed", len(commands) - commands.count(None))
+    return commands
 
 
-def bash_to_pure_bash_cells(string):
-    """Create cells for pure Bash notebook (with Bash kernel)"""
-    # TODO: share code with the function below
-    # TODO: preserve syntax more while still handling d.out.file
-    cells = []
-    output = []
-    prev_line = ""
-    d_command_present = False
-    last_command = None
-    for line in string.splitlines():
-        if line:
-            if line.endswith("\\"):
-                prev_line += line + "\n"
+class CodeBackend(object):
+    """Render commands of a code block as cells of one output language
+
+    Subclasses define how a command is written and how rendering of
+    display modules into an image (d.out.file) is shown. Backends which
+    split cells put the image into a separate cell, others keep
+    everything in one cell.
+    """
+
+    # lines at the beginning of each cell
+    header = []
+    # code showing the rendered image
+    image = 'Image(filename="map.png")'
+    split_cells = False
+
+    def command_text(self, command):
+        return command.line
+
+    def is_display_output(self, command):
+        return command.module.name == "d.out.file"
+
+    def is_display(self, command):
+        return command.module.name.startswith("d.")
+
+    def render(self, commands):
+        """Get list of cell sources for list of commands"""
+        return [source for source, _ in self.render_cells(commands)]
+
+    def render_cells(self, commands):
+        """Get list of cell sources with commands rendered in each cell"""
+        cells = []
+        output = list(self.header)
+        output_commands = []
+        d_command_present = False
+        last_command = None
+        for command in commands:
+            if command is None:
+                output.append("\n")
                 continue
-            elif prev_line:
-                line = prev_line + line
-                prev_line = ""
             # TODO: potentially split to cells when d.out.file
-            if line.startswith("d.out.file"):
-                cells.append("\n".join(output))
-                # pseudo cell magic to be replaced later
-                output = ["%%markdown", "![image](map.png)"]
-                cells.append("\n".join(output))
-                output = []
+            if self.is_display_output(command):
+                if self.split_cells:
+                    cells.append(("\n".join(output), output_commands))
+                    cells.append((self.image, []))
+                    output = list(self.header)
+                    output_commands = []
+                else:
+                    output.append(self.image)
             else:
-                output.append(line)
-                if line.startswith("d."):
+                output.append(self.command_text(command))
+                output_commands.append(command)
+                if self.is_display(command):
                     d_command_present = True
-            last_command = line
-        else:
-            output.append("\n")
-    if output:
-        cells.append("\n".join(output))
-    if d_command_present and not last_command.startswith("d.out.file"):
-        cells.append("\n".join(["%%markdown", "![image](map.png)"]))
-    return cells
+            last_command = command
+        if not self.split_cells:
+            if d_command_present and not self.is_display_output(last_command):
+                output.append(self.image)
+            return [("\n".join(output), output_commands)]
+        if len(output) > len(self.header):
+            cells.append(("\n".join(output), output_commands))
+        if d_command_present and not self.is_display_output(last_command):
+            cells.append((self.image, []))
+        return cells
+
+
+class PythonBackend(CodeBackend):
+    """Python code using grass.script"""
+
+    def command_text(self, command):
+        return module_to_python(command.module)
+
+
+class ExclamationBackend(CodeBackend):
+    """Commands prefixed by exclamation mark in a Python notebook"""
+
+    # the ! syntax is limited just to simple commands
+    # TODO: but pipe is supported as long as it is in one line
+
+    def command_text(self, command):
+        # exclamations support continued lines with backslash
+        return "!" + command.line
+
+
+class BashCellBackend(CodeBackend):
+    """Cells with %%bash cell magic in a Python notebook"""
+
+    # TODO: preserve syntax more while still handling d.out.file
+    header = ["%%bash"]
+    split_cells = True
+
+    # commands are not parsed, so any Bash syntax can be used
+    def is_display_output(self, command):
+        return command.line.startswith("d.out.file")
+
+    def is_display(self, command):
+        return command.line.startswith("d.")
+
+
+class PureBashBackend(BashCellBackend):
+    """Cells for pure Bash notebook (with Bash kernel)"""
+
+    header = []
+    # pseudo cell magic to be replaced later
+    image = "\n".join(["%%markdown", "![image](map.png)"])
+
+
+# backends for output syntax names used by the converters
+code_backends = {
+    "python": PythonBackend(),
+    "!": ExclamationBackend(),
+    "cell": BashCellBackend(),
+    "pure": PureBashBackend(),
+}
+
+
+def bash_to_python(string):
+    return code_backends["python"].render(parse_code_block(string))
+
+
+def bash_to_pure_bash_cells(string):
+    """Create cells for pure Bash notebook (with Bash kernel)"""
+    return code_backends["pure"].render(parse_code_block(string))
 
 
 def bash_to_cells(string):
@@ -369,70 +894,64 @@ def bash_to_cells(string):
     Image(filename="map.png")
 
     """
-    # TODO: preserve syntax more while still handling d.out.file
-    cells = []
-    output = ["%%bash"]
-    prev_line = ""
-    d_command_present = False
-    last_command = None
-    for line in string.splitlines():
-        if line:
-            if line.endswith("\\"):
-                prev_line += line + "\n"
-                continue
-            elif prev_line:
-                line = prev_line + line
-                prev_line = ""
-            # TODO: potentially split to cells when d.out.file
-            if line.startswith("d.out.file"):
-                cells.append("\n".join(output))
-                cells.append('Image(filename="map.png")')
-                output = ["%%bash"]
-            else:
-                output.append(line)
-                if line.startswith("d."):
-                    d_command_present = True
-            last_command = line
-        else:
-            output.append("\n")
-    if len(output) > 1:
-        cells.append("\n".join(output))
-    if d_command_present and not last_command.startswith("d.out.file"):
-        cells.append('Image(filename="map.png")')
-    return cells
+    return code_backends["cell"].render(parse_code_block(string))
 
 
 def bash_to_exclamations(string):
     """Create cells for a Python notebook using exclamation mark"""
-    # the ! syntax is limited just to simple commands
-    # TODO: but pipe is supported as long as it is in one line
-    output = []
-    prev_line = ""
-    d_command_present = False
-    last_command = None
-    for line in string.splitlines():
-        if line:
-            if line.endswith("\\"):
-                prev_line += line + "\n"
-                continue
-            elif prev_line:
-                line = prev_line + line
-                prev_line = ""
-            module = string_to_module(line)
-            # TODO: potentially split to cells when d.out.file
-            if line.startswith("d.out.file"):
-                output.append('Image(filename="map.png")')
-            else:
-                # exclamations support continued lines with backslash
-                output.append("!" + line)
-                if module.name.startswith("d."):
-                    d_command_present = True
-            last_command = module.name
-        else:
-            output.append("\n")
-    if d_command_present and last_command != "d.out.file":
-        output.append('Image(filename="map.png")')
-    return ["\n".join(output)]
+    return code_backends["!"].render(parse_code_block(string))
+
+
+# output languages (--lang) with their code syntax and Python 2 flag
+LANGUAGES = {
+    "python": ("python", False),
+    "python2": ("python", True),
+    "bash": ("!", False),
+    "bash-cells": ("cell", False),
+    "pure-bash": ("pure", False),
+}
+
+
+def is_session_start(code):
+    """Check if code block text is a start of GRASS GIS session"""
+    return re.search("^grass.?.?$", code) is not None
+
+
+def code_to_cells(
+    code,
+    syntax,
+    grass,
+    gisdbase,
+    location,
+    mapset,
+    python2=False,
+    commands=None,
+    with_commands=False,
+):
+    """Create cells for code block text (from code_block_to_text)
+
+    The code is parsed unless the *commands* (from parse_code_block)
+    are provided, so that one parse can be rendered in several syntaxes.
+    With *with_commands*, the cells are pairs of source and list of
+    commands in the cell.
+    """
+    if is_session_start(code):
+        cells = start_of_grass_session(
+            code, grass, gisdbase, location, mapset, python2=python2
+        )
+        if syntax != "python":
+            # TODO: the env vars need to be in bash for the pure bash
+            cells = [
+                "# using Python to initialize GRASS GIS\n" + cell for cell in cells
+            ]
+        if with_commands:
+            return [(cell, []) for cell in cells]
+        return cells
+    if commands is None:
+        commands = parse_code_block(code.strip())
+    if with_commands:
+        return code_backends[syntax].render_cells(commands)
+    return code_backends[syntax].render(commands)
 
 
 class DummyProcessor(object):
@@ -448,11 +967,145 @@ class DummyProcessor(object):
                         output += " " + arg
                 for key, value in kwargs.items():
                     output += " %s=%s" % (key, value)
-                # print(output)
+                print(output)
 
         return Attr(name)
 
 
+DEFAULT_CODE_START = r"^<pre><code>$"
+DEFAULT_CODE_END = r"^</code></pre>$"
+
+# line kinds recognized by LineClassifier (bit flags, one line can be more)
+FILE_CONTENT_START = 1
+FILE_CONTENT_END = 2
+CODE_START = 4
+CODE_END = 8
+COMMENT_START = 16
+COMMENT_END = 32
+
+# regular expression which is just (possibly anchored) literal text
+literal_pattern = LazyPattern(r"^(\^?)((?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])+)(\$?)$")
+
+
+def _compile_line_test(pattern):
+    """Compile pattern to a line test
+
+    Returns a pair of the whole line text (when the pattern is just
+    anchored literal text, so the test is a string comparison) and
+    a function which searches the line (for other patterns).
+    Exactly one of the two items is None.
+
+    >>> _compile_line_test(r"^</code></pre>$")
+    ('</code></pre>', None)
+    >>> text, test = _compile_line_test(r"^<pre>")
+    >>> bool(test("<pre><code>")), bool(test("a <pre>"))
+    (True, False)
+    >>> text, test = _compile_line_test(r"^\s*<pre>")
+    >>> bool(test("  <pre>"))
+    True
+    """
+    match = literal_pattern.search(pattern)
+    if match and match.group(1) and match.group(3):
+        return re.sub(r"\\(.)", r"\1", match.group(2)), None
+    # other literals are fast enough with search (literal prefix optimization)
+    return None, re.compile(pattern).search
+
+
+def _required_character(pattern):
+    """Get a character which must be in any line matching the pattern
+
+    Returns None when the pattern is not just (anchored) literal text.
+
+    >>> _required_character(r"^<pre>"), _required_character(r"^\s*<pre>")
+    ('<', None)
+    """
+    match = literal_pattern.search(pattern)
+    if not match:
+        return None
+    return re.sub(r"\\(.)", r"\1", match.group(2))[0]
+
+
+class LineClassifier(object):
+    """Classify lines for the Splitter in one pass
+
+    Patterns which match only one exact line (such as the default code
+    tags) are merged into a dictionary which maps these lines to their
+    full classification, so they are all tested by one lookup.
+    The remaining patterns are tested only when the line is not one of
+    these exact lines and when it contains at least one character which
+    these patterns require (most lines of text and code do not).
+
+    >>> c = LineClassifier(DEFAULT_CODE_START, DEFAULT_CODE_END)
+    >>> c.classify("d.rast elevation")
+    0
+    >>> c.classify("<pre><code>") == CODE_START
+    True
+    >>> c.classify("<!-- d.erase -->") == COMMENT_START | COMMENT_END
+    True
+    >>> c = LineClassifier(r"^<pre><code>", r"</code></pre>$")
+    >>> c.classify("<pre><code>g.region -p") == CODE_START
+    True
+    """
+
+    def __init__(self, code_start, code_end):
+        # required characters given for patterns which are not literals
+        patterns = [
+            (FILE_CONTENT_START, r"^<pre data-filename=.*>$", "<"),
+            (FILE_CONTENT_END, r"^</pre>$", None),
+            (CODE_START, code_start, None),
+            (CODE_END, code_end, None),
+            (COMMENT_START, r"^\s*<!--", "<"),
+            (COMMENT_END, r"-->\s*$", ">"),
+        ]
+        exact_lines = []
+        self._tests = []
+        markers = set()
+        for kind, pattern, marker in patterns:
+            text, test = _compile_line_test(pattern)
+            if test:
+                self._tests.append((kind, test))
+                markers.add(marker or _required_character(pattern))
+            else:
+                exact_lines.append((kind, text))
+        if None in markers:
+            # some pattern can match without any specific character
+            self._markers = None
+        else:
+            self._markers = sorted(markers)
+        self._exact = {}
+        for kind, text in exact_lines:
+            self._exact[text] = self._exact.get(text, 0) | kind
+        # exact lines can also match the other patterns
+        for text in self._exact:
+            self._exact[text] |= self._classify_tests(text)
+
+    def _classify_tests(self, line):
+        kind = 0
+        for flag, test in self._tests:
+            if test(line):
+                kind |= flag
+        return kind
+
+    def classify(self, line):
+        """Return bit flags of all kinds the line matches (0 for none)"""
+        kind = self._exact.get(line)
+        if kind is not None:
+            return kind
+        if self._markers:
+            for marker in self._markers:
+                if marker in line:
+                    break
+            else:
+                return 0
+        # each test is compiled regular expression, so this is a quick
+        # sequence of calls to C code
+        kind = 0
+        for flag, test in self._tests:
+            if test(line):
+                kind |= flag
+        return kind
+
+
 # first split document into
 # blocks/cells of code and text and than convert each of the items
 class Splitter(object):
@@ -471,6 +1124,8 @@ class Splitter(object):
     ['<h2>Display</h2>', '']
     >>> p.blocks[2]['content']
     ['', "And that's it."]
+    >>> [block['lines'] for block in p.blocks]
+    [(1, 2), (3, 5), (6, 7)]
 
     >>> t2 = "Display\n\n<!--\n<pre><code>\nd.erase\n</code></pre>\n-->\n\nEnd.\n"
     >>> p = Processor()
@@ -547,46 +1202,56 @@ class Splitter(object):
     """  # noqa: E501
 
     def __init__(self, processor, code_tags=None):
+        if code_tags is None:
+            code_tags = (DEFAULT_CODE_START, DEFAULT_CODE_END)
         assert len(code_tags) == 2
         self.processor = processor
-        self.code_start = re.compile(code_tags[0])
-        self.code_end = re.compile(code_tags[1])
-        self.file_content_start = re.compile(r"^<pre data-filename=.*>$")
-        self.file_content_end = re.compile(r"^</pre>$")
-        self.comment_start = re.compile(r"^\s*<!--")
-        self.comment_end = re.compile(r"-->\s*$")
+        self.classifier = LineClassifier(code_tags[0], code_tags[1])
         self.in_code = False
         self.in_file_content = False
         self.in_block_comment = False
 
     def split(self, text):
-        for line in text.splitlines():
-            if self.file_content_start.search(line) and not self.in_block_comment:
-                self.in_file_content = True
-                self.processor.start_file_content(line)
-                continue
-            elif self.in_file_content and self.file_content_end.search(line):
-                self.in_file_content = False
-                self.processor.end_file_content(line)
-                continue
-            elif self.code_start.search(line) and not self.in_block_comment:
-                self.in_code = True
-                self.processor.start_code(line)
-                continue
-            elif self.in_code and self.code_end.search(line):
-                self.in_code = False
-                self.processor.end_code(line)
-                continue
-            elif self.comment_start.search(line) and not self.comment_end.search(line):
-                self.in_block_comment = True
-            elif self.in_block_comment and self.comment_end.search(line):
-                self.in_block_comment = False
+        self.split_lines(text.splitlines())
+
+    def split_lines(self, lines):
+        """Split lines from an iterable such as an open file
+
+        Trailing line endings are ignored, so lines can come directly
+        from a file object.
+        """
+        classify = self.classifier.classify
+        processor = self.processor
+        for line in lines:
+            line = line.rstrip("\r\n")
+            kind = classify(line)
+            if kind:
+                if kind & FILE_CONTENT_START and not self.in_block_comment:
+                    self.in_file_content = True
+                    processor.start_file_content(line)
+                    continue
+                elif self.in_file_content and kind & FILE_CONTENT_END:
+                    self.in_file_content = False
+                    processor.end_file_content(line)
+                    continue
+                elif kind & CODE_START and not self.in_block_comment:
+                    self.in_code = True
+                    processor.start_code(line)
+                    continue
+                elif self.in_code and kind & CODE_END:
+                    self.in_code = False
+                    processor.end_code(line)
+                    continue
+                elif kind & COMMENT_START and not kind & COMMENT_END:
+                    self.in_block_comment = True
+                elif self.in_block_comment and kind & COMMENT_END:
+                    self.in_block_comment = False
             if self.in_code:
-                self.processor.add_code(line)
+                processor.add_code(line)
             elif self.in_file_content:
-                self.processor.add_file_content(line)
+                processor.add_file_content(line)
             else:
-                self.processor.add_text(line)
+                processor.add_text(line)
 
 
 class Processor(object):
@@ -614,13 +1279,28 @@ class Processor(object):
     >>> p.blocks[1]['block_type']
     'text'
 
+    >>> finished = []
+    >>> p = Processor(on_block=finished.append)
+    >>> p.add_text('Some text')
+    >>> p.start_code('')
+    >>> p.add_code('d.rast fractals')
+    >>> p.end_code('')
+    >>> [block['block_type'] for block in finished]
+    ['text', 'code']
+    >>> p.blocks
+    []
+
     """  # noqa: E501
 
-    def __init__(self):
+    def __init__(self, on_block=None):
         self._current_code = None
         self._current_file_content = None
         self._current_text = None
         self._blocks = []
+        # number of lines in the finished blocks (each line is in one block)
+        self._lines = 0
+        # when provided, finished blocks are passed here instead of stored
+        self._on_block = on_block
 
         # text is background content
         self.start_text()
@@ -636,11 +1316,22 @@ class Processor(object):
         if self._current_text:
             self.end_text()
 
-    def add_block(self, block_type, content, attrs=None):
+    def _next_lines(self, count):
+        """Get first and last line number of a block with *count* lines"""
+        first = self._lines + 1
+        self._lines += count
+        return first, self._lines
+
+    def add_block(self, block_type, content, attrs=None, lines=None):
         block = {"block_type": block_type, "content": content}
         if attrs:
             block["attrs"] = attrs
-        self._blocks.append(block)
+        if lines:
+            block["lines"] = lines
+        if self._on_block:
+            self._on_block(block)
+        else:
+            self._blocks.append(block)
 
     def start_text(self, text=None):
         self._current_text = []
@@ -651,11 +1342,12 @@ class Processor(object):
         self._current_text.append(text)
 
     def end_text(self, text=None):
+        lines = self._next_lines(len(self._current_text or []))
         # empty text blocks are ignored
         if not self._current_text or not any(self._current_text):
             self._current_text = None
             return
-        self.add_block(block_type="text", content=self._current_text)
+        self.add_block(block_type="text", content=self._current_text, lines=lines)
         self._current_text = None
 
     def start_code(self, text=None):
@@ -666,7 +1358,9 @@ class Processor(object):
         self._current_code.append(text)
 
     def end_code(self, text=None):
-        self.add_block(block_type="code", content=self._current_code)
+        # with the start and end lines
+        lines = self._next_lines(len(self._current_code) + 2)
+        self.add_block(block_type="code", content=self._current_code, lines=lines)
         self._current_code = None
         self.start_text()
 
@@ -686,13 +1380,129 @@ class Processor(object):
 
     def end_file_content(self, text=None):
         attrs = {"filename": self._current_filename}
+        lines = self._next_lines(len(self._current_file_content) + 2)
         self.add_block(
-            block_type="file_content", content=self._current_file_content, attrs=attrs
+            block_type="file_content",
+            content=self._current_file_content,
+            attrs=attrs,
+            lines=lines,
         )
         self.start_text()
 
 
-class HTMLBashCodeToPythonNotebookConverter(HTMLParser):
+class TextBuffer(object):
+    r"""Text built from pieces which are joined only when the text is needed
+
+    Appending to a string in a loop can be quadratic, appending to a list
+    of pieces is not.
+
+    >>> b = TextBuffer()
+    >>> b.write("g.region ")
+    >>> b.write("raster=elevation")
+    >>> b.write("")
+    >>> b.endswith("\n")
+    False
+    >>> b.getvalue()
+    'g.region raster=elevation'
+    """
+
+    def __init__(self):
+        self._chunks = []
+        # plain list append, empty pieces are harmless
+        self.write = self._chunks.append
+
+    def endswith(self, suffix):
+        # suffixes used here are single characters
+        for chunk in reversed(self._chunks):
+            if chunk:
+                return chunk.endswith(suffix)
+        return False
+
+    def getvalue(self):
+        if len(self._chunks) > 1:
+            # the same list object is kept since its append is used directly
+            self._chunks[:] = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def clear(self):
+        del self._chunks[:]
+
+
+class BufferedHTMLParser(HTMLParser):
+    """Base for the converters collecting their output in a TextBuffer
+
+    The converters can be reused for another block after reset().
+    Configuration is set in the constructor, state of the current block
+    is (re)initialized in reset().
+    """
+
+    def __init__(self):
+        # before HTMLParser which calls reset()
+        self.buffer = TextBuffer()
+        self.write = self.buffer.write
+        HTMLParser.__init__(self)
+
+    def reset(self):
+        """Discard all state of the current block"""
+        HTMLParser.reset(self)
+        self.buffer.clear()
+
+    @property
+    def data(self):
+        """Text collected so far"""
+        return self.buffer.getvalue()
+
+    def handle_data(self, data):
+        self.write(data)
+
+    def handle_entityref(self, name):
+        self.write(chr(name2codepoint[name]))
+
+    def clear(self):
+        self.buffer.clear()
+
+
+inline_comment = LazyPattern("<!--.*-->")
+
+
+def code_block_to_text(text):
+    """Remove comments, ignored and empty lines from code block text"""
+    lines = []
+    for line in text.splitlines():
+        line = inline_comment.sub("", line)
+        skip_line = False
+        for ignored_line in ignored_lines:
+            if ignored_line.search(line):
+                skip_line = True
+        if not skip_line:
+            for regexp, replacement in code_replacemets:
+                line = regexp.sub(replacement, line)
+            if line:
+                lines.append(line)
+    if not lines:
+        return ""
+    return "\n".join(lines) + "\n"
+
+
+class HTMLBashCodeParser(BufferedHTMLParser):
+    r"""Get text of a code block keeping d.erase from comments
+
+    >>> c = HTMLBashCodeParser()
+    >>> c.feed("g.region raster=elevation\n<!-- d.erase -->\nd.rast elevation")
+    >>> c.text().splitlines()
+    ['g.region raster=elevation', 'd.erase', 'd.rast elevation']
+    """
+
+    def handle_comment(self, data):
+        if data.strip().startswith("d.erase"):
+            self.write(data.strip())
+
+    def text(self):
+        """Code without comments, ignored and empty lines"""
+        return code_block_to_text(self.data)
+
+
+class HTMLBashCodeToPythonNotebookConverter(HTMLBashCodeParser):
     r"""
 
     >>> n = nb.new_notebook()
@@ -718,10 +1528,9 @@ class HTMLBashCodeToPythonNotebookConverter(HTMLParser):
         mapset=None,
         python2=False,
     ):
-        HTMLParser.__init__(self)
+        BufferedHTMLParser.__init__(self)
 
         self.nb = notebook
-        self.data = ""
 
         self.grass = grass
         self.gisdbase = gisdbase
@@ -730,48 +1539,23 @@ class HTMLBashCodeToPythonNotebookConverter(HTMLParser):
 
         self.python2 = python2
 
-    def handle_data(self, data):
-        self.data += data
+    def finish(self):
+        cells = code_to_cells(
+            self.text(),
+            "python",
+            self.grass,
+            self.gisdbase,
+            self.location,
+            self.mapset,
+            python2=self.python2,
+        )
+        for cell in cells:
+            self.nb["cells"].append(new_code_cell(cell))
+        self.clear()
 
-    def handle_entityref(self, name):
-        c = chr(name2codepoint[name])
-        self.data += c
 
-    def handle_comment(self, data):
-        if data.strip().startswith("d.erase"):
-            self.data += data.strip()
-
-    def finish(self):
-        cell = ""
-        for line in self.data.splitlines():
-            line = re.sub("<!--.*-->", "", line)
-            skip_line = False
-            for ignored_line in ignored_lines:
-                if ignored_line.search(line):
-                    skip_line = True
-            if not skip_line:
-                for regexp, replacement in code_replacemets:
-                    line = regexp.sub(replacement, line)
-                if line:
-                    cell += line + "\n"
-        if re.search("^grass.?.?$", cell):
-            cells = start_of_grass_session(
-                cell,
-                self.grass,
-                self.gisdbase,
-                self.location,
-                self.mapset,
-                python2=self.python2,
-            )
-        else:
-            cells = bash_to_python(cell.strip())
-        for cell in cells:
-            self.nb["cells"].append(nb.new_code_cell(cell))
-        self.data = ""
-
-
-class HTMLBashCodeToNotebookConverter(HTMLParser):
-    r"""
+class HTMLBashCodeToNotebookConverter(HTMLBashCodeParser):
+    r"""
 
     >>> t = "g.region raster=elevation\nr.univar elevation\nd.rast elevation"
     >>> n = nb.new_notebook()
@@ -825,66 +1609,35 @@ class HTMLBashCodeToNotebookConverter(HTMLParser):
         location=None,
         mapset=None,
     ):
-        HTMLParser.__init__(self)
+        BufferedHTMLParser.__init__(self)
 
         if syntax not in ("pure", "cell", "!"):
             raise ValueError("Requested output syntax not recognized")
         self._syntax = syntax
 
         self.nb = notebook
-        self.data = ""
 
         self.grass = grass
         self.gisdbase = gisdbase
         self.location = location
         self.mapset = mapset
 
-    def handle_data(self, data):
-        self.data += data
-
-    def handle_entityref(self, name):
-        c = chr(name2codepoint[name])
-        self.data += c
-
-    def handle_comment(self, data):
-        if data.strip().startswith("d.erase"):
-            self.data += data.strip()
-
     def finish(self):
-        cell = ""
-        for line in self.data.splitlines():
-            line = re.sub("<!--.*-->", "", line)
-            skip_line = False
-            for ignored_line in ignored_lines:
-                if ignored_line.search(line):
-                    skip_line = True
-            if not skip_line:
-                for regexp, replacement in code_replacemets:
-                    line = regexp.sub(replacement, line)
-                if line:
-                    cell += line + "\n"
-        if re.search("^grass.?.?$", cell):
-            cells = start_of_grass_session(
-                cell, self.grass, self.gisdbase, self.location, self.mapset
-            )
-            # TODO: the env vars need to be in bash for the pure bash
-            cells = [
-                "# using Python to initialize GRASS GIS\n" + cell for cell in cells
-            ]
-        else:
-            if self._syntax == "pure":
-                cells = bash_to_pure_bash_cells(cell.strip())
-            elif self._syntax == "cell":
-                cells = bash_to_cells(cell.strip())
-            else:
-                cells = bash_to_exclamations(cell.strip())
+        cells = code_to_cells(
+            self.text(),
+            self._syntax,
+            self.grass,
+            self.gisdbase,
+            self.location,
+            self.mapset,
+        )
         for cell in cells:
             # TODO: deal with the pseudo cell magic %%markdown cells
-            self.nb["cells"].append(nb.new_code_cell(cell))
-        self.data = ""
+            self.nb["cells"].append(new_code_cell(cell))
+        self.clear()
 
 
-class HTMLFileContentToPythonNotebookConverter(HTMLParser):
+class HTMLFileContentToPythonNotebookConverter(BufferedHTMLParser):
     r"""
 
     >>> n = nb.new_notebook()
@@ -900,29 +1653,25 @@ class HTMLFileContentToPythonNotebookConverter(HTMLParser):
 
     """
 
-    def __init__(self, notebook, filename):
-        HTMLParser.__init__(self)
+    def __init__(self, notebook, filename=None):
+        BufferedHTMLParser.__init__(self)
 
         self.nb = notebook
         self.filename = filename
-        self.data = ""
 
-    def handle_data(self, data):
-        self.data += data
-
-    def handle_entityref(self, name):
-        c = chr(name2codepoint[name])
-        self.data += c
+    def reset(self, filename=None):
+        BufferedHTMLParser.reset(self)
+        self.filename = filename
 
     def finish(self):
         cell = ""
         # process pre content as file
         cell = "%%%%file %s\n%s" % (self.filename, self.data.strip())
-        self.nb["cells"].append(nb.new_code_cell(cell))
-        self.data = ""
+        self.nb["cells"].append(new_code_cell(cell))
+        self.clear()
 
 
-class HTMLToMarkdownNotebookConverter(HTMLParser):
+class HTMLToMarkdownNotebookConverter(BufferedHTMLParser):
     r"""
 
     >>> n = nb.new_notebook()
@@ -949,65 +1698,63 @@ class HTMLToMarkdownNotebookConverter(HTMLParser):
     """
 
     def __init__(self, notebook):
-        HTMLParser.__init__(self)
-
-        self.in_pre = False
+        BufferedHTMLParser.__init__(self)
 
         self.nb = notebook
-        self.data = ""
-        # used to carry hyperlink data
-        self.link_url = None
+
+    def reset(self):
+        BufferedHTMLParser.reset(self)
+        self.in_pre = False
         # used to carry hyperlink data
         self.link_url = None
-
         self.download_files = []
 
     def finish(self):
         # process text
         cell = self.data.strip()
         if cell:
-            self.nb["cells"].append(nb.new_markdown_cell(cell))
-            self.data = ""
+            self.nb["cells"].append(new_markdown_cell(cell))
+            self.clear()
 
     def handle_starttag(self, tag, attrs):
         if re.search(r"^h(\d)$", tag):
             # TODO: check std heading syntax
             nchars = int(tag[1])
-            self.data += "#" * nchars + " "
+            self.write("#" * nchars + " ")
         elif tag == "li":
-            if self.data[-1] != "\n":
-                self.data += "\n"
-            self.data += "* "
+            if not self.buffer.endswith("\n"):
+                self.write("\n")
+            self.write("* ")
         elif tag == "em":
             # TODO: more robust test
             # TODO: list to module
             # if 'class' in attrs and 'module' in attrs['class']:
-            self.data += "_"
+            self.write("_")
         elif tag == "a":
-            self.data += "["
+            self.write("[")
             # possibly just store last tag attrs
             for key, value in attrs:
                 if key == "href":
                     self.link_url = value
                     break
         elif tag == "code" and not self.in_pre:
-            self.data += "`"
+            self.write("`")
         elif tag == "pre":
             self.in_pre = True
-            self.data += "```"
+            self.write("```")
         # elif tag == 'blockquote':
-        #    self.data += '\n\n\t'
+        #    self.write('\n\n\t')
 
     def handle_endtag(self, tag):
         # if tag == 'blockquote':
-        #     self.data += "\n\n"
+        #     self.write("\n\n")
         if tag == "em":
-            self.data += "_"
+            self.write("_")
         elif tag == "a":
             # TODO: URLs need adding
             # http://ncsu-geoforall-lab.github.io/geospatial-modeling-course/grass/
             # if any relative (as in ../ etc., not just data/)
-            self.data += "](%s)" % self.link_url
+            self.write("](%s)" % self.link_url)
             if self.link_url.startswith("data/"):
                 self.download_files.append(
                     # URL-only lines should be ignored automatically
@@ -1016,91 +1763,2666 @@ class HTMLToMarkdownNotebookConverter(HTMLParser):
                 )
             self.link_url = None
         elif tag == "pre":
-            self.data += "```"
+            self.write("```")
             self.in_pre = False
         elif tag == "code" and not self.in_pre:
-            self.data += "`"
-
-    def handle_data(self, data):
-        self.data += data
+            self.write("`")
 
     def handle_entityref(self, name):
         if name == "ndash":
-            self.data += "--"
+            self.write("--")
         else:
             c = chr(name2codepoint[name])
-            self.data += c
+            self.write(c)
 
 
-def add_file_downloads(notebook, filenames, python2):
+# notebook format version of the created notebooks
+NBFORMAT = 4
+NBFORMAT_MINOR = 5
+
+
+def new_code_cell(source):
+    """Create code cell as nbformat.v4.new_code_cell but without validation
+
+    The cells are created according to the schema, so the validation
+    (which is done when the whole notebook is written) is not needed.
+    """
+    return nbf.NotebookNode(
+        id=uuid.uuid4().hex[:8],
+        cell_type="code",
+        metadata=nbf.NotebookNode(),
+        execution_count=None,
+        source=source,
+        outputs=[],
+    )
+
+
+def new_markdown_cell(source):
+    """Create Markdown cell as nbformat.v4.new_markdown_cell without validation"""
+    return nbf.NotebookNode(
+        id=uuid.uuid4().hex[:8],
+        cell_type="markdown",
+        metadata=nbf.NotebookNode(),
+        source=source,
+    )
+
+
+class NotebookStreamWriter(object):
+    r"""Write notebook as nbformat 4 JSON cell by cell
+
+    It is used in place of a notebook by the converters and the
+    NotebookBuilder which only append cells. Cells are serialized right
+    away into a temporary file and the notebook is written by close().
+    The download cell, which is known only at the end, is inserted into
+    a position recorded when the cells were added (as in CellList).
+    The JSON is formatted in the same way as nbformat formats it.
+
+    >>> import io
+    >>> f = io.BytesIO()
+    >>> w = NotebookStreamWriter(f)
+    >>> w["metadata"]["kernelspec"] = {"name": "python3"}
+    >>> w["cells"].append({"cell_type": "markdown", "id": "a", "metadata": {},
+    ...                    "source": "# Title\nText"})
+    >>> w.close()
+    >>> print(f.getvalue().decode())
+    {
+     "cells": [
+      {
+       "cell_type": "markdown",
+       "id": "a",
+       "metadata": {},
+       "source": [
+        "# Title\n",
+        "Text"
+       ]
+      }
+     ],
+     "metadata": {
+      "kernelspec": {
+       "name": "python3"
+      }
+     },
+     "nbformat": 4,
+     "nbformat_minor": 5
+    }
+    <BLANKLINE>
+    """
+
+    def __init__(self, file):
+        self._file = file
+        self._spool = tempfile.TemporaryFile()
+        self.metadata = {}
+        self._count = 0
+        # spool offsets: end of cell at index 1 (default download position),
+        # start of anchor cells (see CellList), start of an empty cell just
+        # before the download marker
+        self._second_cell_end = None
+        self._anchors = {}
+        self._skipped_start = None
+        self._last_cell_start = None
+        self._last_cell_source = None
+        self._downloads = None
+        self._default_download_start = None
+
+    def __getitem__(self, key):
+        if key == "cells":
+            return self
+        if key == "metadata":
+            return self.metadata
+        raise KeyError(key)
+
+    def __len__(self):
+        return self._count
+
+    def append(self, cell):
+        start = self._spool.tell()
+        source = cell["source"]
+        for name in cell_anchors(cell):
+            if name in self._anchors:
+                continue
+            self._anchors[name] = start
+            if name == "download_marker" and self._last_cell_start is not None:
+                if not self._last_cell_source:
+                    self._skipped_start = self._last_cell_start
+        self._spool.write(self._serialize(cell))
+        self._last_cell_start = start
+        self._last_cell_source = source
+        self._count += 1
+        if self._count == 2:
+            self._second_cell_end = self._spool.tell()
+
+    @staticmethod
+    def _serialize(cell):
+        """Get cell JSON as bytes indented for the cell list
+
+        Each cell starts with a separator (the one of the first cell
+        is removed when the notebook is written).
+        """
+        cell = dict(cell, source=cell["source"].splitlines(True))
+        text = json.dumps(
+            cell, indent=1, sort_keys=True, separators=(",", ": "), ensure_ascii=False
+        )
+        return (",\n" + "\n".join("  " + line for line in text.splitlines())).encode()
+
+    def add_file_downloads(self, filenames, python2):
+        """Same as add_file_downloads() for a notebook in memory"""
+        self._downloads = file_downloads_code(filenames, python2)
+        # same as list insert at index 2 (cells added later come after)
+        if self._second_cell_end is not None:
+            self._default_download_start = self._second_cell_end
+        else:
+            self._default_download_start = self._spool.tell()
+
+    def _segments(self):
+        """Generate spool offset ranges and inserted cells in output order"""
+        end = self._spool.tell()
+        if self._downloads is None:
+            yield (0, end)
+            return
+        marker = self._anchors.get("download_marker")
+        if marker is None:
+            insert_at = skip_from = self._anchors.get(
+                "session_start", self._default_download_start
+            )
+        else:
+            # before the marker, possibly replacing an empty cell
+            insert_at = marker
+            skip_from = self._skipped_start
+            if skip_from is None:
+                skip_from = insert_at
+        yield (0, skip_from)
+        yield new_code_cell(self._downloads)
+        yield (insert_at, end)
+
+    def close(self):
+        skeleton = json.dumps(
+            {
+                "cells": [],
+                "metadata": self.metadata,
+                "nbformat": NBFORMAT,
+                "nbformat_minor": NBFORMAT_MINOR,
+            },
+            indent=1,
+            sort_keys=True,
+            separators=(",", ": "),
+            ensure_ascii=False,
+        )
+        head, tail = skeleton.split('"cells": []', 1)
+        if not self._count:
+            self._file.write((skeleton + "\n").encode())
+            self._spool.close()
+            return
+        self._file.write((head + '"cells": [').encode())
+        first = True
+        for segment in self._segments():
+            if isinstance(segment, tuple):
+                start, end = segment
+                if start == end:
+                    continue
+                if first:
+                    start += 1
+                    first = False
+                self._spool.seek(start)
+                _copy_range(self._spool, self._file, end - start)
+            else:
+                data = self._serialize(segment)
+                if first:
+                    data = data[1:]
+                    first = False
+                self._file.write(data)
+        self._file.write(("\n ]" + tail + "\n").encode())
+        self._spool.close()
+
+
+def _copy_range(source, target, size, chunk_size=1024 * 1024):
+    while size > 0:
+        data = source.read(min(size, chunk_size))
+        if not data:
+            break
+        target.write(data)
+        size -= len(data)
+
+
+# text of a cell before which the download cell is placed
+DOWNLOAD_MARKER = "Download all text files"
+# line of the cell starting the GRASS GIS session (see GRASS_START_CODE)
+SESSION_START_MARKER = "# create GRASS GIS runtime environment"
+
+
+def cell_anchors(cell):
+    """Get names of anchors (see CellList) the cell is when it is the first"""
+    names = []
+    source = cell["source"]
+    if cell["cell_type"] == "markdown":
+        names.append("first_text")
+    if source.startswith(DOWNLOAD_MARKER):
+        names.append("download_marker")
+    elif SESSION_START_MARKER in source:
+        names.append("session_start")
+    return names
+
+
+def file_downloads_code(filenames, python2):
+    """Create code downloading files (each only once, in the given order)"""
     cell = "# a proper directory is already set, download files\n"
     if python2:
         cell += "import urllib\n"
     else:
         cell += "import urllib.request\n"
-    for filename in filenames:
+    for filename in dict.fromkeys(filenames):
         name = filename.split("/")[-1]
         if python2:
             cell += 'urllib.urlretrieve("%s", "%s")\n' % (filename, name)
         else:
             cell += 'urllib.request.urlretrieve("%s", "%s")\n' % (filename, name)
-    cell = cell.strip()
-    download_text_index = None
-    for i, existing_cell in enumerate(notebook["cells"]):
-        if existing_cell.source.startswith("Download all text files"):
-            download_text_index = i
-            break
-    if download_text_index is None:
-        # TODO: better guess than 2?
-        notebook["cells"].insert(2, nb.new_code_cell(cell))
+    return cell.strip()
+
+
+class CellList(list):
+    """List of notebook cells which records positions of anchor cells
+
+    The anchors are the first text cell (``first_text``), the download
+    marker cell (``download_marker``) and the cell starting the GRASS GIS
+    session (``session_start``). Their indexes are recorded as the cells
+    are added and updated when cells are inserted, so the cells do not
+    need to be searched.
+
+    >>> cells = CellList()
+    >>> cells.append(new_markdown_cell("# Title"))
+    >>> cells.append(new_markdown_cell(DOWNLOAD_MARKER + " first."))
+    >>> cells.download_marker
+    1
+    >>> cells.insert(0, new_code_cell("import os"))
+    >>> cells.anchors
+    {'first_text': 1, 'download_marker': 2}
+    """
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.anchors = {}
+        for i, cell in enumerate(self):
+            self._record_anchors(cell, i)
+
+    @property
+    def download_marker(self):
+        return self.anchors.get("download_marker")
+
+    def _record_anchors(self, cell, index):
+        for name in cell_anchors(cell):
+            if self.anchors.get(name, index) >= index:
+                self.anchors[name] = index
+
+    def append(self, cell):
+        self._record_anchors(cell, len(self))
+        list.append(self, cell)
+
+    def insert(self, index, cell):
+        index = min(index, len(self))
+        for name, position in self.anchors.items():
+            if position >= index:
+                self.anchors[name] = position + 1
+        list.insert(self, index, cell)
+        self._record_anchors(cell, index)
+
+
+def add_file_downloads(notebook, filenames, python2):
+    """Add cell downloading files before the download marker cell
+
+    The cell is placed before the start of the GRASS GIS session when there
+    is no marker and at index 2 when there is no session either. An empty
+    cell just before the marker is replaced by the download cell.
+    """
+    cell = new_code_cell(file_downloads_code(filenames, python2))
+    cells = notebook["cells"]
+    if not isinstance(cells, CellList):
+        cells = notebook["cells"] = CellList(cells)
+    index = cells.download_marker
+    if index is None:
+        cells.insert(cells.anchors.get("session_start", 2), cell)
+    elif index and not cells[index - 1]["source"]:
+        cells[index - 1] = cell
     else:
         # insert before
-        notebook["cells"].insert(download_text_index, nb.new_code_cell(cell))
-        if not notebook["cells"][download_text_index - 1].source:
-            del notebook["cells"][download_text_index - 1]
+        cells.insert(index, cell)
 
 
 def finish_session(notebook):
-    code = "# end the GRASS session\nos.remove(rcfile)"
-    notebook["cells"].append(nb.new_code_cell(code))
+    notebook["cells"].append(new_code_cell(GRASS_END_CODE.strip()))
+
+
+def _bash_quote(text):
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+class ScriptWriter(NotebookStreamWriter):
+    r"""Write code cells as Python or Bash script instead of a notebook
+
+    It is used in the same way as NotebookStreamWriter. Python languages
+    give a Python script, the others a Bash script. Markdown cells and
+    code showing images are left out, the notebook-only parts (cell magics,
+    exclamation marks, session code in Python for Bash) are replaced by
+    plain code. Code of each block is preceded by a comment with the lines
+    of the block in the *source* file (see :meth:`start_block`).
+
+    >>> import io
+    >>> from argparse import Namespace
+    >>> args = Namespace(grass="grass", gisdbase="/data", location="nc",
+    ...                  mapset="user1")
+    >>> f = io.BytesIO()
+    >>> w = ScriptWriter(f, "bash", args, source="r.info.html")
+    >>> w.start_block({"block_type": "code", "lines": (3, 6)})
+    >>> w["cells"].append(new_code_cell("!r.info elevation\n"
+    ...                                 'Image(filename="map.png")'))
+    >>> w.start_block({"block_type": "file_content", "lines": (8, 11)})
+    >>> w["cells"].append(new_code_cell("%%file rules.txt\n50 blue\n70 aqua"))
+    >>> w.close()
+    >>> print(f.getvalue().decode())
+    #!/usr/bin/env bash
+    # stop at the first error
+    set -e
+    <BLANKLINE>
+    # r.info.html:3-6
+    r.info elevation
+    <BLANKLINE>
+    # r.info.html:8-11
+    cat > 'rules.txt' << 'EOF'
+    50 blue
+    70 aqua
+    EOF
+    <BLANKLINE>
+    """
+
+    # lines of notebook code which are left out
+    dropped_lines = {
+        CodeBackend.image,
+        "%%bash",
+        "from IPython.display import Image",
+    }
+
+    def __init__(self, file, lang, args, source=None):
+        NotebookStreamWriter.__init__(self, file)
+        syntax, python2 = LANGUAGES[lang]
+        self.bash = syntax != "python"
+        self.python2 = python2
+        self.source = source
+        self._block_comment = None
+        # cells of the session code replaced by a different code (or none)
+        session = code_to_cells(
+            "grass",
+            syntax,
+            args.grass,
+            args.gisdbase,
+            args.location,
+            args.mapset,
+            python2=python2,
+        )
+        if self.bash:
+            replacements = [
+                BASH_GRASS_START_CODE.format(
+                    grass=args.grass,
+                    gisdbase=args.gisdbase,
+                    location=args.location,
+                    mapset=args.mapset,
+                ),
+                BASH_GRASS_SETTINGS_CODE,
+                BASH_GRASS_START_DISPLAY_CODE,
+            ]
+            self._replacements = dict(zip(session[1:], replacements))
+            self._replacements[GRASS_END_CODE.strip()] = BASH_GRASS_END_CODE
+        else:
+            self._replacements = {}
+        # introduction into Jupyter Notebook
+        self._replacements[session[0]] = ""
+
+    def start_block(self, block):
+        """Put source location of *block* before its code (if there is any)"""
+        lines = block.get("lines")
+        if not lines:
+            self._block_comment = None
+            return
+        first, last = lines
+        self._block_comment = "# %s:%d-%d" % (self.source or "lines", first, last)
+
+    def script_code(self, source):
+        """Get code for a script from code cell *source*"""
+        if source in self._replacements:
+            return self._replacements[source].strip()
+        if source.startswith("%%file "):
+            filename, content = (source[len("%%file ") :] + "\n").split("\n", 1)
+            return self.file_code(filename, content)
+        if source.startswith("%%markdown"):
+            return ""
+        lines = []
+        for line in source.splitlines():
+            if line in self.dropped_lines:
+                continue
+            if self.bash and line.startswith("!"):
+                line = line[1:]
+            lines.append(line)
+        return "\n".join(lines).strip()
+
+    def file_code(self, filename, content):
+        """Get code writing *content* to a file (same as the %%file magic)"""
+        if self.bash:
+            end = "EOF"
+            while end in content.splitlines():
+                end += "_"
+            return "cat > %s << '%s'\n%s%s" % (_bash_quote(filename), end, content, end)
+        lines = ['with open(%r, "w") as f:' % filename, "    f.write("]
+        lines.extend("        %r" % line for line in content.splitlines(True))
+        lines.append("    )")
+        return "\n".join(lines)
+
+    def _serialize(self, cell):
+        """Get script code of a cell as bytes (empty for no code)"""
+        if cell["cell_type"] != "code":
+            # text block (no code)
+            self._block_comment = None
+            return b""
+        code = self.script_code(cell["source"])
+        if not code:
+            return b""
+        if self._block_comment:
+            code = self._block_comment + "\n" + code
+            self._block_comment = None
+        return ("\n" + code + "\n").encode()
+
+    def add_file_downloads(self, filenames, python2):
+        r"""Same as add_file_downloads() for a notebook in memory
+
+        The downloads are placed as in a notebook: before the download
+        marker, otherwise before the start of the session, otherwise after
+        the second cell. The text and the introduction are not in the
+        script, so in the last case, the downloads are at its beginning.
+
+        >>> import io
+        >>> from argparse import Namespace
+        >>> args = Namespace(grass="grass", gisdbase="/data", location="nc",
+        ...                  mapset="user1")
+        >>> f = io.BytesIO()
+        >>> w = ScriptWriter(f, "python", args)
+        >>> w["cells"].append(new_markdown_cell("Text"))
+        >>> w["cells"].append(new_code_cell(JUPYTER_INTRODUCTION_CODE.strip()))
+        >>> w["cells"].append(new_code_cell("print(open('x.txt').read())"))
+        >>> w.add_file_downloads(["http://example.com/data/x.txt"], False)
+        >>> w.close()
+        >>> print(f.getvalue().decode())
+        #!/usr/bin/env python3
+        <BLANKLINE>
+        # a proper directory is already set, download files
+        import urllib.request
+        urllib.request.urlretrieve("http://example.com/data/x.txt", "x.txt")
+        <BLANKLINE>
+        print(open('x.txt').read())
+        <BLANKLINE>
+        """
+        NotebookStreamWriter.add_file_downloads(self, filenames, python2)
+        if self.bash:
+            lines = ["# a proper directory is already set, download files"]
+            for filename in dict.fromkeys(filenames):
+                name = filename.split("/")[-1]
+                lines.append(
+                    "curl -fsSL -o %s %s" % (_bash_quote(name), _bash_quote(filename))
+                )
+            self._downloads = "\n".join(lines)
+
+    def header(self):
+        if self.bash:
+            return "#!/usr/bin/env bash\n# stop at the first error\nset -e\n"
+        if self.python2:
+            return "#!/usr/bin/env python2\n# -*- coding: utf-8 -*-\n"
+        return "#!/usr/bin/env python3\n"
+
+    def close(self):
+        # the download code is not in any block
+        self._block_comment = None
+        self._file.write(self.header().encode())
+        for segment in self._segments():
+            if isinstance(segment, tuple):
+                start, end = segment
+                self._spool.seek(start)
+                _copy_range(self._spool, self._file, end - start)
+            else:
+                self._file.write(self._serialize(segment))
+        self._spool.close()
+
+
+def copy_cell(cell):
+    """Create a new cell of the same type, source and metadata"""
+    if cell["cell_type"] == "markdown":
+        new_cell = new_markdown_cell(cell["source"])
+    else:
+        new_cell = new_code_cell(cell["source"])
+    if cell.get("metadata"):
+        new_cell["metadata"].update(cell["metadata"])
+    return new_cell
+
+
+class BlockConverter(object):
+    """Convert blocks to cells for each language reusing the parsers
+
+    The configuration (*args* and *langs*) is given once and the parsers
+    are only reset for each block.
+    """
+
+    def __init__(self, args, langs):
+        self.args = args
+        self.langs = langs
+        # converters add cells here, then they are copied for each language
+        self._cells = []
+        scratch = {"cells": self._cells}
+        self._code = HTMLBashCodeParser()
+        self._file_content = HTMLFileContentToPythonNotebookConverter(scratch)
+        self._text = HTMLToMarkdownNotebookConverter(scratch)
+
+    def _fan_out(self):
+        # first language gets the cells, the others their copies
+        cells = {self.langs[0]: list(self._cells)}
+        for lang in self.langs[1:]:
+            cells[lang] = [copy_cell(cell) for cell in self._cells]
+        del self._cells[:]
+        return cells
+
+    def _code_cell(self, source, commands):
+        cell = new_code_cell(source)
+        if commands and getattr(self.args, "dependencies", False):
+            inputs = set()
+            outputs = set()
+            for command in commands:
+                try:
+                    command_inputs, command_outputs = command_maps(command.module)
+                except ValueError:
+                    # Bash syntax which cannot be parsed (not needed otherwise)
+                    continue
+                # maps created in the same cell are not inputs of the cell
+                inputs.update(command_inputs - outputs)
+                outputs.update(command_outputs)
+            cell["metadata"]["gdoc2nb"] = {
+                "inputs": sorted(inputs),
+                "outputs": sorted(outputs),
+            }
+        return cell
+
+    def start(self, block):
+        """Get parser for content of *block* (reset for a new block)
+
+        The content is fed to the parser (or its events are passed to it)
+        and then the cells are created by :meth:`finish`.
+        """
+        if block["block_type"] == "code":
+            self._code.reset()
+            return self._code
+        if block["block_type"] == "file_content":
+            self._file_content.reset(filename=block["attrs"]["filename"])
+            return self._file_content
+        self._text.reset()
+        return self._text
+
+    def convert(self, block):
+        """Same as :func:`convert_block`"""
+        parser = self.start(block)
+        if "events" in block:
+            # recorded by HTMLSplitter
+            for name, event_args in block["events"]:
+                getattr(parser, name)(*event_args)
+        else:
+            parser.feed("\n".join(block["content"]))
+        return self.finish(block)
+
+    def finish(self, block):
+        """Create cells of *block* from its parser (see :meth:`start`)"""
+        args = self.args
+        download_files = []
+        if block["block_type"] == "code":
+            code = self._code.text()
+            commands = None
+            if not is_session_start(code):
+                commands = parse_code_block(code.strip())
+            cells = {}
+            for lang in self.langs:
+                syntax, python2 = LANGUAGES[lang]
+                sources = code_to_cells(
+                    code,
+                    syntax,
+                    args.grass,
+                    args.gisdbase,
+                    args.location,
+                    args.mapset,
+                    python2=python2,
+                    commands=commands,
+                    with_commands=True,
+                )
+                cells[lang] = [
+                    self._code_cell(source, cell_commands)
+                    for source, cell_commands in sources
+                ]
+            return cells, download_files
+        if block["block_type"] == "file_content":
+            self._file_content.finish()
+        elif block["block_type"] == "text":
+            self._text.finish()
+            download_files = self._text.download_files
+        return self._fan_out(), download_files
+
+
+# converter reused while the options stay the same
+_block_converter = None
+
+
+def block_converter(args, langs):
+    """Get BlockConverter for *args* and *langs* (reused when possible)"""
+    global _block_converter
+    converter = _block_converter
+    if (
+        converter is None
+        or converter.langs != langs
+        or conversion_options(converter.args) != conversion_options(args)
+    ):
+        converter = _block_converter = BlockConverter(args, langs)
+    return converter
+
+
+def convert_block(block, args, langs):
+    """Convert one block from :class:`Processor` to cells for each language
+
+    Returns dictionary with list of cells for each of *langs* and list
+    of files to download linked from the block. The result does not
+    depend on other blocks, so blocks can be converted in any order
+    (or in parallel) and then added in the document order by
+    :meth:`NotebookBuilder.add_converted_block`.
+    """
+    return block_converter(args, langs).convert(block)
+
+
+class DependencyGraph(object):
+    """Dependencies between code cells given by maps they use and create
+
+    Cells are identified by their ids, so that the graph stays valid when
+    other cells are inserted. A cell depends on the cells which created
+    its inputs before it and, so that the cells can run in any order
+    respecting the dependencies, on the cells which created or used its
+    outputs before it.
+
+    >>> graph = DependencyGraph()
+    >>> graph.add_cell("a", [], ["dem"])
+    >>> graph.add_cell("b", ["dem"], ["slope"])
+    >>> graph.add_cell("c", ["dem"], [])
+    >>> graph.add_cell("d", ["slope"], ["dem"])
+    >>> [cell["depends_on"] for cell in graph.cells]
+    [[], ['a'], ['a'], ['a', 'b', 'c']]
+    >>> sorted(downstream_cells(graph.cells, ["b"]))
+    ['b', 'd']
+    """
+
+    def __init__(self):
+        self.cells = []
+        # map name -> last cell creating the map
+        self._producer = {}
+        # map name -> cells using the map since it was created
+        self._consumers = {}
+
+    def add_cell(self, cell_id, inputs, outputs):
+        depends_on = set()
+        for name in inputs:
+            if name in self._producer:
+                depends_on.add(self._producer[name])
+        for name in outputs:
+            if name in self._producer:
+                depends_on.add(self._producer[name])
+            depends_on.update(self._consumers.get(name, []))
+        depends_on.discard(cell_id)
+        self.cells.append(
+            {
+                "id": cell_id,
+                "inputs": list(inputs),
+                "outputs": list(outputs),
+                "depends_on": sorted(depends_on),
+            }
+        )
+        for name in inputs:
+            self._consumers.setdefault(name, []).append(cell_id)
+        for name in outputs:
+            self._producer[name] = cell_id
+            self._consumers[name] = []
+
+    def as_dict(self):
+        return {"format": 1, "cells": self.cells}
+
+
+def downstream_cells(cells, start):
+    """Get ids of cells depending (also indirectly) on cells in *start*
+
+    The *cells* are the cells of a DependencyGraph (in the notebook order)
+    and the result includes the cells in *start*.
+    """
+    ids = set(start)
+    for cell in cells:
+        if ids.intersection(cell["depends_on"]):
+            ids.add(cell["id"])
+    return ids
+
+
+def query_dependencies(paths, cell=None, map_name=None):
+    r"""Find cells depending on a cell or map in converted notebooks
+
+    The *paths* are notebooks or directories with notebooks converted
+    with dependencies. The *cell* is the index of a cell in each notebook.
+    Returns list of (notebook path, cell index, cell id) for all the cells
+    depending on the cell (directly or indirectly), not including the cell
+    itself. For a map, these are the cells creating or using the map
+    and all the cells depending on them.
+
+    >>> from argparse import Namespace
+    >>> args = Namespace(**dict.fromkeys(CACHE_KEY_OPTIONS))
+    >>> args.lang, args.dependencies = "python", True
+    >>> args.code_start, args.code_end = DEFAULT_CODE_START, DEFAULT_CODE_END
+    >>> notebook = convert("<pre><code>\n"
+    ...     "r.neighbors input=dem output=sl\n"
+    ...     "r.neighbors input=sl output=sl_avg\n"
+    ...     "</code></pre>\n<pre><code>\nr.univar map=sl_avg\n</code></pre>\n"
+    ...     "<pre><code>\nr.univar map=dem\n</code></pre>\n", args)
+    >>> path = os.path.join(tempfile.mkdtemp(), "r.neighbors.ipynb")
+    >>> with open(path, "w") as f:
+    ...     nbf.write(notebook, f)
+    >>> [index for _, index, _ in query_dependencies([path], map_name="sl")]
+    [0, 1]
+    >>> [index for _, index, _ in query_dependencies([path], cell=0)]
+    [1]
+    """
+    results = []
+    for path in collect_inputs(paths, extensions=(".ipynb",)):
+        with open(path, encoding="utf-8") as f:
+            notebook = json.load(f)
+        metadata = notebook["metadata"].get("gdoc2nb", {})
+        if "dependencies" not in metadata:
+            continue
+        cells = metadata["dependencies"]["cells"]
+        ids = [c.get("id") for c in notebook["cells"]]
+        start = []
+        if cell is not None and cell < len(ids):
+            start.append(ids[cell])
+        if map_name:
+            # a map created and used in one cell is only in its outputs
+            start.extend(
+                c["id"]
+                for c in cells
+                if map_name in c["inputs"] or map_name in c["outputs"]
+            )
+        if not start:
+            continue
+        found = downstream_cells(cells, start)
+        if cell is not None and cell < len(ids):
+            found.discard(ids[cell])
+        for index, cell_id in enumerate(ids):
+            if cell_id in found:
+                results.append((path, index, cell_id))
+    return results
+
+
+def write_dependencies(notebook, path):
+    """Write dependency graph from notebook metadata to a JSON file"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(notebook["metadata"]["gdoc2nb"]["dependencies"], f, indent=1)
+        f.write("\n")
+
+
+class NotebookBuilder(object):
+    """Convert blocks from :class:`Processor` to notebook cells one by one
+
+    Blocks can be added as soon as they are finished, so the whole
+    document does not need to be kept in memory.
+
+    The *notebooks* dictionary has a notebook for each output language.
+    Text and file content blocks are converted once for all notebooks,
+    code blocks are parsed once and only rendered for each language.
+    """
+
+    def __init__(self, notebooks, args):
+        self.notebooks = notebooks
+        self.args = args
+        self.converter = block_converter(args, list(notebooks))
+        self.graphs = {}
+        if getattr(args, "dependencies", False):
+            self.graphs = dict((lang, DependencyGraph()) for lang in notebooks)
+        # dictionary as an ordered set
+        self.filenames = {}
+        self.add_session_start = False
+        self.first_text_cell = True
+
+    def add_block(self, block):
+        profiler.count("blocks_" + block["block_type"])
+        with profiler.stage(block["block_type"]):
+            cells, download_files = self.converter.convert(block)
+            self.add_converted_block(block, cells, download_files)
+
+    def add_converted_block(self, block, cells, download_files):
+        """Add cells from :func:`convert_block` (in the document order)
+
+        The session started after the first text is the same as the one
+        from a code block, so it is replaced by Bash code in scripts.
+
+        >>> import io, subprocess
+        >>> from argparse import Namespace
+        >>> args = Namespace(**dict.fromkeys(CACHE_KEY_OPTIONS))
+        >>> args.grass, args.gisdbase = "grass", "/data"
+        >>> args.location, args.mapset = "nc", "user1"
+        >>> args.session_after_text = True
+        >>> f = io.BytesIO()
+        >>> script = ScriptWriter(f, "bash", args)
+        >>> builder = NotebookBuilder({"bash": script}, args)
+        >>> builder.add_block({"block_type": "text", "content": ["Text"]})
+        >>> builder.add_block({"block_type": "code", "content": ["r.info dem"]})
+        >>> builder.finish()
+        >>> script.close()
+        >>> code = f.getvalue().decode()
+        >>> "import" in code, "export GISRC" in code
+        (False, True)
+        >>> subprocess.run(["bash", "-n"], input=code.encode()).returncode
+        0
+        """
+        args = self.args
+        if self.add_session_start:
+            self.add_session_start = False
+            for lang, notebook in self.notebooks.items():
+                # same cells as for a code block starting the session
+                syntax, python2 = LANGUAGES[lang]
+                sources = code_to_cells(
+                    "grass",
+                    syntax,
+                    args.grass,
+                    args.gisdbase,
+                    args.location,
+                    args.mapset,
+                    python2=python2,
+                )
+                for source in sources:
+                    notebook["cells"].append(new_code_cell(source))
+        for lang, notebook in self.notebooks.items():
+            if isinstance(notebook, ScriptWriter):
+                notebook.start_block(block)
+            for cell in cells[lang]:
+                notebook["cells"].append(cell)
+                if lang in self.graphs and "gdoc2nb" in cell["metadata"]:
+                    maps = cell["metadata"]["gdoc2nb"]
+                    self.graphs[lang].add_cell(
+                        cell["id"], maps["inputs"], maps["outputs"]
+                    )
+        if block["block_type"] == "text":
+            self.filenames.update(dict.fromkeys(download_files))
+            if self.first_text_cell and args.session_after_text:
+                self.add_session_start = True
+            self.first_text_cell = False
+
+    def finish(self):
+        for lang, notebook in self.notebooks.items():
+            if self.filenames:
+                python2 = lang == "python2"
+                if isinstance(notebook, NotebookStreamWriter):
+                    notebook.add_file_downloads(self.filenames, python2)
+                else:
+                    add_file_downloads(notebook, self.filenames, python2)
+            finish_session(notebook)
+            if lang in self.graphs:
+                notebook["metadata"]["gdoc2nb"] = {
+                    "dependencies": self.graphs[lang].as_dict()
+                }
+
+
+class ParserEvents(object):
+    """Record events for a parser to be passed to it later
+
+    >>> events = ParserEvents([])
+    >>> events.handle_starttag("em", [])
+    >>> events.handle_data("text")
+    >>> events.events
+    [('handle_starttag', ('em', [])), ('handle_data', ('text',))]
+    """
+
+    def __init__(self, events):
+        self.events = events
+
+    def __getattr__(self, name):
+        if not name.startswith("handle_") and name != "unknown_decl":
+            raise AttributeError(name)
+        return functools.partial(self._record, name)
+
+    def _record(self, name, *args):
+        self.events.append((name, args))
+
+
+class HTMLSplitter(HTMLParser):
+    r"""Split document to blocks and convert them in one pass of HTML parsing
+
+    The blocks are the same as from Splitter with the default code tags
+    (``<pre><code>``, ``<pre data-filename="...">``, not ``<pre
+    data-run="no"><code>``, nothing in comments), but the tags do not need
+    to be alone on their lines. Events of this parser are passed straight
+    to the parser of the current block from the *builder*
+    (NotebookBuilder) and the converted blocks are added to it, so the
+    content of the blocks is not collected and parsed again.
+
+    When a *blocks* list is provided, the blocks are appended to it with
+    the parser events recorded in their ``events`` instead (to be
+    converted later, e.g., in parallel by :func:`convert_block`).
+
+    >>> from argparse import Namespace
+    >>> args = Namespace(**dict.fromkeys(CACHE_KEY_OPTIONS))
+    >>> notebook = nb.new_notebook()
+    >>> builder = NotebookBuilder({"bash": notebook}, args)
+    >>> s = HTMLSplitter(builder)
+    >>> s.feed("<p>Region:<pre><code>g.region -p</code></pre> and colors\n")
+    >>> s.feed('<pre data-filename="c.txt">50 blue</pre>\n<!--\n')
+    >>> s.feed("<pre><code>d.erase\n</code></pre>\n-->\n")
+    >>> s.close()
+    >>> for cell in notebook["cells"]:
+    ...     print(cell["source"])
+    Region:
+    !g.region -p
+    and colors
+    %%file c.txt
+    50 blue
+    """
+
+    def __init__(self, builder, blocks=None):
+        HTMLParser.__init__(self)
+        self.builder = builder
+        self.converter = builder.converter
+        self.blocks = blocks
+        # start tag of pre which can be a start of code (or code end tag)
+        self._pending = None
+        self._pending_line = None
+        self._last_line = 0
+        self._start_block({"block_type": "text"}, 1)
+
+    def _start_block(self, block, first_line):
+        self._block = block
+        self._first_line = first_line
+        if self.blocks is None:
+            self._target = self.converter.start(block)
+        else:
+            block["events"] = []
+            self._target = ParserEvents(block["events"])
+        # empty text blocks are ignored
+        self._has_content = False
+
+    def _end_block(self, last_line):
+        block = self._block
+        self._last_line = last_line
+        if block["block_type"] == "text" and not self._has_content:
+            return
+        block["lines"] = (self._first_line, max(self._first_line, last_line))
+        if self.blocks is not None:
+            self.blocks.append(block)
+            return
+        profiler.count("blocks_" + block["block_type"])
+        with profiler.stage(block["block_type"]):
+            cells, download_files = self.converter.finish(block)
+            self.builder.add_converted_block(block, cells, download_files)
+
+    def _end_and_start_text(self):
+        self._end_block(self.getpos()[0])
+        self._start_block({"block_type": "text"}, self._last_line + 1)
+
+    def _flush_pending(self):
+        """Pass the pending tag to the current block (it was not a marker)"""
+        pending = self._pending
+        if pending is None:
+            return
+        self._pending = None
+        self._has_content = True
+        if pending == "pre":
+            self._target.handle_starttag("pre", [])
+        else:
+            self._target.handle_endtag("code")
+
+    def handle_starttag(self, tag, attrs):
+        if self._pending == "pre" and tag == "code":
+            self._pending = None
+            self._end_block(self._pending_line - 1)
+            self._start_block({"block_type": "code"}, self._pending_line)
+            return
+        self._flush_pending()
+        if tag == "pre" and self._block["block_type"] == "text":
+            filename = dict(attrs).get("data-filename")
+            if filename:
+                line = self.getpos()[0]
+                self._end_block(line - 1)
+                block = {"block_type": "file_content", "attrs": {"filename": filename}}
+                self._start_block(block, line)
+                return
+            if not attrs:
+                self._pending = "pre"
+                self._pending_line = self.getpos()[0]
+                return
+        self._has_content = True
+        self._target.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        block_type = self._block["block_type"]
+        if self._pending == "/code" and tag == "pre":
+            self._pending = None
+            self._end_and_start_text()
+            return
+        self._flush_pending()
+        if block_type == "code" and tag == "code":
+            self._pending = "/code"
+            return
+        if block_type == "file_content" and tag == "pre":
+            self._end_and_start_text()
+            return
+        self._has_content = True
+        self._target.handle_endtag(tag)
+
+    def handle_data(self, data):
+        # most frequent event, so the checks are inline
+        if self._pending is not None:
+            self._flush_pending()
+        if not self._has_content and data.strip():
+            self._has_content = True
+        self._target.handle_data(data)
+
+    def handle_comment(self, data):
+        self._flush_pending()
+        self._has_content = True
+        self._target.handle_comment(data)
+
+    def handle_entityref(self, name):
+        self._flush_pending()
+        self._has_content = True
+        self._target.handle_entityref(name)
+
+    def handle_charref(self, name):
+        self._flush_pending()
+        self._has_content = True
+        self._target.handle_charref(name)
+
+    def handle_decl(self, decl):
+        self._flush_pending()
+        self._target.handle_decl(decl)
+
+    def handle_pi(self, data):
+        self._flush_pending()
+        self._target.handle_pi(data)
+
+    def unknown_decl(self, data):
+        self._flush_pending()
+        self._target.unknown_decl(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        self._flush_pending()
+        # unfinished code or file content is left out as with Splitter
+        if self._block["block_type"] == "text":
+            line, offset = self.getpos()
+            if not offset:
+                # after the last line break
+                line -= 1
+            self._end_block(line)
+
+
+def add_blocks_in_parallel(builder, blocks, processes):
+    r"""Convert *blocks* in a pool of processes and add them to *builder*
+
+    The cells are added in the order of *blocks*, so the result is the
+    same as when the blocks are added one by one.
+
+    >>> from argparse import Namespace
+    >>> args = Namespace(**dict.fromkeys(CACHE_KEY_OPTIONS))
+    >>> args.lang = "python,bash"
+    >>> args.code_start, args.code_end = DEFAULT_CODE_START, DEFAULT_CODE_END
+    >>> args.session_after_text = True
+    >>> page = (
+    ...     "<h2>Example</h2>\n<p>See <a href='data/c.txt'>colors</a>:"
+    ...     "<pre><code>r.info elevation</code></pre> and</p>\n"
+    ...     '<pre data-filename="c.txt">\n50 blue\n</pre>\n'
+    ...     "<!--\n<pre><code>\nd.erase\n</code></pre>\n-->\n"
+    ...     "<pre><code>\nr.colors map=elevation rules=c.txt\n</code></pre>\n"
+    ...     '<pre data-run="no"><code>d.mon wx0</code></pre>\n'
+    ... )
+    >>> sequential = convert_languages(page, args)
+    >>> args.block_jobs = 2
+    >>> parallel = convert_languages(page, args)
+    >>> def cells(notebook):
+    ...     return [(c["cell_type"], c["source"]) for c in notebook["cells"]]
+    >>> [cells(parallel[lang]) == cells(sequential[lang]) for lang in parallel]
+    [True, True]
+    >>> len(parallel["python"]["cells"])
+    12
+    """
+    import multiprocessing
+
+    convert = functools.partial(
+        _convert_block_job, args=builder.args, langs=list(builder.notebooks)
+    )
+    # larger chunks mean less communication, but the chunks must be
+    # small enough to keep all processes busy
+    chunksize = max(1, len(blocks) // (processes * 4))
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.imap(convert, blocks, chunksize=chunksize)
+        for block, (cells, download_files) in zip(blocks, results):
+            profiler.count("blocks_" + block["block_type"])
+            for lang in cells:
+                cells[lang] = [copy_cell(cell) for cell in cells[lang]]
+            builder.add_converted_block(block, cells, download_files)
+
+
+def _convert_block_job(block, args, langs):
+    # loaded only once in each process
+    use_module_index(getattr(args, "module_index", None))
+    cells, download_files = convert_block(block, args, langs)
+    # plain dictionaries are much faster to send back than notebook nodes
+    for lang in cells:
+        cells[lang] = [
+            {
+                "cell_type": cell["cell_type"],
+                "source": cell["source"],
+                "metadata": dict(cell["metadata"]),
+            }
+            for cell in cells[lang]
+        ]
+    return cells, download_files
+
+
+def languages(args):
+    """Get list of output languages from comma-separated *args.lang*"""
+    return args.lang.split(",")
+
+
+def language_list(value):
+    """Check comma-separated list of output languages (for argparse)
+
+    >>> language_list("python,pure-bash")
+    'python,pure-bash'
+    >>> language_list("python,perl")
+    Traceback (most recent call last):
+    ...
+    argparse.ArgumentTypeError: unknown language 'perl' (choose from python, python2, bash, bash-cells, pure-bash)
+    """  # noqa: E501
+    langs = value.split(",")
+    for lang in langs:
+        if lang not in LANGUAGES:
+            raise argparse.ArgumentTypeError(
+                "unknown language %r (choose from %s)" % (lang, ", ".join(LANGUAGES))
+            )
+    if len(set(langs)) != len(langs):
+        raise argparse.ArgumentTypeError("language listed more than once")
+    return value
+
+
+def language_args(args, lang):
+    """Get copy of *args* with only one output language"""
+    args = argparse.Namespace(**vars(args))
+    args.lang = lang
+    return args
+
+
+def output_extension(lang, output_format="notebook"):
+    """Get file name extension for a language and output format (--format)"""
+    if output_format != "script":
+        return "ipynb"
+    if LANGUAGES[lang][0] == "python":
+        return "py"
+    return "sh"
+
+
+def language_outputs(output, langs, output_format="notebook"):
+    """Get output file name for each language from a file name template
+
+    The *output* contains ``{lang}`` which is replaced by the language
+    (required for more than one language). The ``{ext}`` is replaced
+    by the extension for the language and *output_format*.
+
+    >>> language_outputs("r.info.{lang}.ipynb", ["python", "bash"])
+    {'python': 'r.info.python.ipynb', 'bash': 'r.info.bash.ipynb'}
+    >>> language_outputs("r.info.ipynb", ["python"])
+    {'python': 'r.info.ipynb'}
+    >>> language_outputs("r.info.{lang}.{ext}", ["python", "bash"], "script")
+    {'python': 'r.info.python.py', 'bash': 'r.info.bash.sh'}
+    """
+    if len(langs) > 1 and "{lang}" not in output:
+        raise ValueError(
+            "Output file name needs {lang} placeholder for more than one language"
+        )
+    return dict(
+        (
+            lang,
+            output.replace("{lang}", lang).replace(
+                "{ext}", output_extension(lang, output_format)
+            ),
+        )
+        for lang in langs
+    )
+
+
+def output_format(args):
+    return getattr(args, "format", None) or "notebook"
+
+
+def text_chunks(lines, size=64 * 1024):
+    r"""Join lines to chunks of about *size* characters
+
+    Feeding a parser with larger chunks is faster than line by line.
+
+    >>> list(text_chunks(["a\n", "b\n", "c"], size=3))
+    ['a\nb\n', 'c']
+    """
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield "".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield "".join(chunk)
+
+
+def convert(text, args, notebook=None):
+    """Convert HTML document to a notebook using options in *args*
+
+    The *text* is either the whole document as a string or an iterable
+    of lines such as an open file. In the latter case, the document is
+    processed as a stream and only the block being currently converted
+    is kept in memory.
+
+    The *args* object is the namespace created by the command line parser
+    in :func:`main` (or anything with the same attributes).
+
+    The cells are added to a new notebook unless *notebook* is provided
+    (e.g., NotebookStreamWriter).
+    """
+    if len(languages(args)) != 1:
+        raise ValueError("Use convert_languages() for more than one language")
+    notebooks = None
+    if notebook is not None:
+        notebooks = {args.lang: notebook}
+    return convert_languages(text, args, notebooks)[args.lang]
+
+
+def convert_languages(text, args, notebooks=None):
+    r"""Convert HTML document to a notebook for each language in *args.lang*
+
+    Same as :func:`convert`, but the document is read and split only once
+    and only the code is rendered separately for each language.
+    Returns dictionary with notebook for each language.
+    The *notebooks* dictionary can provide the notebooks to use.
+
+    >>> from argparse import Namespace
+    >>> args = Namespace(**dict.fromkeys(CACHE_KEY_OPTIONS))
+    >>> args.lang = "python,bash"
+    >>> args.code_start, args.code_end = DEFAULT_CODE_START, DEFAULT_CODE_END
+    >>> notebooks = convert_languages("<pre><code>\ng.region raster=elevation\n"
+    ...     "</code></pre>\n", args)
+    >>> for notebook in notebooks.values():
+    ...     print(notebook["cells"][0]["source"])
+    gs.run_command('g.region', raster="elevation")
+    !g.region raster=elevation
+
+    Blocks are the same when they are converted in parallel:
+
+    >>> text = "<p>Region:<pre><code>g.region -p</code></pre> and colors</p>"
+    >>> args.lang = "python"
+    >>> sequential = convert(text, args)
+    >>> args.block_jobs = 2
+    >>> parallel = convert(text, args)
+    >>> for cell in parallel["cells"]:
+    ...     print(cell["source"])
+    Region:
+    gs.parse_command('g.region', flags='pg')
+    and colors
+    # end the GRASS session
+    os.remove(rcfile)
+    >>> [c["source"] for c in sequential["cells"]] == [
+    ...     c["source"] for c in parallel["cells"]]
+    True
+    """
+    if notebooks is None:
+        notebooks = {}
+    for lang in languages(args):
+        notebook = notebooks.get(lang)
+        if notebook is None:
+            notebook = notebooks[lang] = nb.new_notebook()
+            notebook["cells"] = CellList()
+        if lang == "python2":
+            notebook["metadata"]["kernelspec"] = {
+                "display_name": "Python 2",
+                "language": "python",
+                "name": "python2",
+            }
+        else:
+            notebook["metadata"]["kernelspec"] = {
+                "display_name": "Python 3",
+                "language": "python",
+                "name": "python3",
+            }
+
+    use_module_index(getattr(args, "module_index", None))
+    builder = NotebookBuilder(notebooks, args)
+    processes = getattr(args, "block_jobs", None) or 1
+    if processes > 1:
+        import multiprocessing
+
+        # workers of batch mode or server cannot start their own processes
+        if multiprocessing.current_process().daemon:
+            processes = 1
+    code_tags = (args.code_start, args.code_end)
+    # with more processes, all blocks are collected first
+    blocks = None
+    if code_tags == (DEFAULT_CODE_START, DEFAULT_CODE_END):
+        # blocks are converted as the document is parsed
+        if processes > 1:
+            blocks = []
+        splitter = HTMLSplitter(builder, blocks)
+        with profiler.stage("split"):
+            if isinstance(text, str):
+                splitter.feed(text)
+            else:
+                for chunk in text_chunks(text):
+                    splitter.feed(chunk)
+            splitter.close()
+    else:
+        # lines are matched with the code tag patterns
+        if processes > 1:
+            processor = Processor()
+        else:
+            processor = Processor(on_block=builder.add_block)
+        splitter = Splitter(processor, code_tags=code_tags)
+        with profiler.stage("split"):
+            if isinstance(text, str):
+                splitter.split(text)
+            else:
+                splitter.split_lines(text)
+            processor.finish()
+        if processes > 1:
+            blocks = processor.blocks
+    if blocks is not None:
+        with profiler.stage("blocks"):
+            add_blocks_in_parallel(builder, blocks, processes)
+    with profiler.stage("finish"):
+        builder.finish()
+    return notebooks
+
+
+# encoding of input files unless specified otherwise
+DEFAULT_ENCODING = "utf-8"
+
+# command line options which influence the resulting notebook
+CACHE_KEY_OPTIONS = (
+    "encoding",
+    "lang",
+    "grass",
+    "gisdbase",
+    "location",
+    "mapset",
+    "code_start",
+    "code_end",
+    "session_after_text",
+    "module_index",
+    "dependencies",
+)
+
+
+class ConversionCache(object):
+    """On-disk cache of converted notebooks
+
+    Entries are keyed by hash of the input content, all options which
+    influence the output, and the version of this tool. Least recently
+    used entries are removed when the total size exceeds *max_size*
+    (in bytes). Hit refreshes the modification time of an entry which is
+    then used for the eviction.
+
+    >>> import tempfile
+    >>> from argparse import Namespace
+    >>> cache = ConversionCache(tempfile.mkdtemp())
+    >>> args = Namespace(**dict.fromkeys(CACHE_KEY_OPTIONS, ""))
+    >>> key = cache.key(b"<p>Text</p>", args)
+    >>> key == cache.key(b"<p>Text</p>", args)
+    True
+    >>> args.lang = "bash"
+    >>> key == cache.key(b"<p>Text</p>", args)
+    False
+    >>> cache.get(key) is None
+    True
+
+    The module index is in the key with its size and modification time,
+    so a rebuilt index gives a new key:
+
+    >>> args.module_index = os.path.join(cache.directory, "modules.json")
+    >>> with open(args.module_index, "w") as f:
+    ...     _ = f.write("{}")
+    >>> key = cache.key(b"<p>Text</p>", args)
+    >>> with open(args.module_index, "w") as f:
+    ...     _ = f.write('{"r.info": {}}')
+    >>> key == cache.key(b"<p>Text</p>", args)
+    False
+    """
+
+    # file name extension of the entries
+    suffix = ".ipynb"
+    # age (in seconds) of temporary files considered left by killed processes
+    stale_age = 3600
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def _finish_key(self, digest, args):
+        # the content is hashed first, so it can be shared by several keys
+        digest.update(b"\0")
+        digest.update(__version__.encode())
+        for name in CACHE_KEY_OPTIONS:
+            value = getattr(args, name, None)
+            digest.update(b"\0%s=%r" % (name.encode(), value))
+        index = getattr(args, "module_index", None)
+        if index:
+            # the index can be rebuilt under the same name
+            try:
+                stat = os.stat(index)
+            except FileNotFoundError:
+                pass
+            else:
+                digest.update(b"\0%d:%d" % (stat.st_mtime_ns, stat.st_size))
+        return digest.hexdigest()
+
+    def key(self, content, args):
+        import hashlib
+
+        return self._finish_key(hashlib.sha256(content), args)
+
+    def file_key(self, path, args, chunk_size=1024 * 1024):
+        """Same as key() but reads the content from a file in chunks"""
+        return self.file_keys(path, [args], chunk_size)[0]
+
+    def file_keys(self, path, args_list, chunk_size=1024 * 1024):
+        """Get key for each of *args_list* reading the file only once"""
+        import hashlib
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        return [self._finish_key(digest.copy(), args) for args in args_list]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Get path to the cached notebook or None"""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, notebook):
+        """Store notebook and return path to it
+
+        Entries are not evicted here (see :meth:`evict`), but the entry
+        can be evicted by another process at any time.
+        """
+        path = self._path(key)
+        # write under a unique name and rename for concurrent workers
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            nbf.write(notebook, f)
+        os.replace(tmp_path, path)
+        return path
+
+    def entries(self):
+        """Get list of (modification time, size, path) of all entries"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _remove_temporary_files(self, min_age=0):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.stat(path).st_mtime >= min_age:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """Remove least recently used entries over the size limit
+
+        Temporary files left by killed processes are removed too.
+
+        >>> import tempfile
+        >>> cache = ConversionCache(tempfile.mkdtemp(), max_size=0)
+        >>> path = cache.put("a", nb.new_notebook())
+        >>> with open(path + ".1.tmp", "w") as f:
+        ...     _ = f.write("{")
+        >>> os.utime(path + ".1.tmp", (0, 0))
+        >>> cache.evict()
+        >>> os.listdir(cache.directory)
+        []
+        """
+        self._remove_temporary_files(self.stale_age)
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self._remove_temporary_files()
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ExecutionCache(ConversionCache):
+    r"""On-disk cache of outputs of executed code cells
+
+    The key of a cell is a hash of its source and the key of the code
+    cell before it, so it changes when any code before the cell changes
+    (including the session code). Entries are evicted in the same way as
+    in ConversionCache (but only when :meth:`evict` is called).
+
+    >>> import tempfile
+    >>> cache = ExecutionCache(tempfile.mkdtemp())
+    >>> keys = cache.cell_keys(["import os", "a = 1", "print(a)"])
+    >>> changed = cache.cell_keys(["import os", "a = 2", "print(a)"])
+    >>> keys[0] == changed[0], keys[2] == changed[2]
+    (True, False)
+    >>> cache.get(keys[0]) is None
+    True
+    >>> outputs = [{"output_type": "stream", "name": "stdout", "text": "1\n"}]
+    >>> cache.put(keys[0], outputs)
+    >>> cache.get(keys[0]) == outputs
+    True
+    """
+
+    suffix = ".json"
+
+    def cell_keys(self, sources, environment=""):
+        """Get key for each of code cell *sources* (in the notebook order)
+
+        The *environment* distinguishes runs which give different outputs
+        for the same code.
+        """
+        import hashlib
+
+        key = hashlib.sha256(("%s\0%s" % (__version__, environment)).encode())
+        key = key.hexdigest()
+        keys = []
+        for source in sources:
+            digest = hashlib.sha256(key.encode())
+            digest.update(b"\0")
+            digest.update(source.encode("utf-8"))
+            key = digest.hexdigest()
+            keys.append(key)
+        return keys
+
+    def get(self, key):
+        """Get list of outputs of the cell or None"""
+        path = ConversionCache.get(self, key)
+        if path is None:
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            # removed or being written by another process
+            return None
+
+    def put(self, key, outputs):
+        """Store list of outputs of the cell"""
+        path = self._path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(outputs, f)
+        os.replace(tmp_path, path)
+
+
+def convert_file(input_, output, args, cache=None):
+    """Convert one HTML file to a notebook file
+
+    With more than one language in *args*, the *output* is a template
+    (see :func:`language_outputs`) and all notebooks are created from
+    one conversion. When *cache* is provided, unchanged inputs are copied
+    from it. When profiling is requested in *args*, the profile is written
+    next to the output file.
+    """
+    global profiler
+    if not getattr(args, "profile", False) and not getattr(args, "cprofile", False):
+        _convert_file(input_, output, args, cache)
+        return
+    profiler = Profile()
+    python_profiler = None
+    if args.cprofile:
+        import cProfile
+
+        python_profiler = cProfile.Profile()
+        python_profiler.enable()
+    try:
+        _convert_file(input_, output, args, cache)
+    finally:
+        # one profile for all languages
+        langs = languages(args)
+        output = output.replace("{lang}", "-".join(langs)).replace(
+            "{ext}", output_extension(langs[0], output_format(args))
+        )
+        if python_profiler:
+            python_profiler.disable()
+            python_profiler.dump_stats(output + ".prof")
+        result = profiler.as_dict()
+        profiler = NullProfile()
+    if args.profile:
+        result["input"] = input_
+        result["output"] = output
+        with open(output + ".profile.json", "w") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+
+
+def input_encoding(args):
+    return getattr(args, "encoding", None) or DEFAULT_ENCODING
+
+
+def input_lines(path, args):
+    r"""Iterate over lines of a file decoding only the current line
+
+    The file is memory-mapped, so even a very large file is not read
+    into memory. The encoding is taken from *args* (default UTF-8).
+
+    >>> from argparse import Namespace
+    >>> with tempfile.NamedTemporaryFile(suffix=".html") as f:
+    ...     _ = f.write("<p>\nText – more\n</p>".encode("utf-8"))
+    ...     f.flush()
+    ...     list(input_lines(f.name, Namespace(encoding="utf-8")))
+    ['<p>\n', 'Text – more\n', '</p>']
+    """
+    import mmap
+
+    encoding = input_encoding(args)
+    if "\n".encode(encoding) != b"\n":
+        # lines cannot be found in the bytes (e.g., UTF-16)
+        with open(path, encoding=encoding) as f:
+            yield from f
+        return
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            # empty file cannot be mapped
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for line in iter(data.readline, b""):
+                yield line.decode(encoding)
+
+
+def _convert_file(input_, output, args, cache):
+    outputs = language_outputs(output, languages(args), output_format(args))
+    _write_notebooks(input_, outputs, args, cache)
+    if getattr(args, "dependencies", False):
+        for filename in outputs.values():
+            # the same for notebooks from cache and from the stream writer
+            with open(filename, encoding="utf-8") as f:
+                notebook = json.load(f)
+            write_dependencies(notebook, filename + ".dependencies.json")
+
+
+def _write_notebooks(input_, outputs, args, cache):
+    script = output_format(args) == "script"
+    # scripts are quick to create, so they are not cached
+    if cache and not script:
+        import shutil
+
+        keys = cache.file_keys(input_, [language_args(args, lang) for lang in outputs])
+        keys = dict(zip(outputs, keys))
+        cached = dict((lang, cache.get(key)) for lang, key in keys.items())
+        if all(cached.values()):
+            try:
+                for lang, filename in outputs.items():
+                    shutil.copyfile(cached[lang], filename)
+                profiler.count("cache_hits")
+                return
+            except FileNotFoundError:
+                # evicted by another process, so it is converted again
+                pass
+        notebooks = convert_languages(input_lines(input_, args), args)
+        with profiler.stage("write"):
+            for lang, filename in outputs.items():
+                path = cache.put(keys[lang], notebooks[lang])
+                try:
+                    shutil.copyfile(path, filename)
+                except FileNotFoundError:
+                    # evicted by another process, so it is written again
+                    with open(filename, "w", encoding="utf-8") as f:
+                        nbf.write(notebooks[lang], f)
+        cache.evict()
+        return
+    if script or getattr(args, "stream_writer", False):
+        with contextlib.ExitStack() as stack:
+            writers = {}
+            for lang, filename in outputs.items():
+                output_file = stack.enter_context(open(filename, "wb"))
+                if script:
+                    writers[lang] = ScriptWriter(output_file, lang, args, input_)
+                else:
+                    writers[lang] = NotebookStreamWriter(output_file)
+            convert_languages(input_lines(input_, args), args, notebooks=writers)
+            with profiler.stage("write"):
+                for writer in writers.values():
+                    writer.close()
+        return
+    notebooks = convert_languages(input_lines(input_, args), args)
+    with profiler.stage("write"):
+        for lang, filename in outputs.items():
+            with open(filename, "w", encoding="utf-8") as f:
+                nbf.write(notebooks[lang], f)
+
+
+def cache_from_args(args):
+    """Create cache according to the command line options (or None)"""
+    if not getattr(args, "cache_dir", None):
+        return None
+    return ConversionCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+
+
+def collect_inputs(paths, extensions=(".html", ".htm")):
+    """Expand directories in *paths* to the HTML files they contain
+
+    Files are kept as they are, directories are searched (not recursively)
+    for files with one of the *extensions*. The order is preserved for files
+    and sorted by name for directory content.
+    """
+    inputs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(extensions):
+                    inputs.append(os.path.join(path, name))
+        else:
+            inputs.append(path)
+    return inputs
+
+
+def output_path(input_, output_dir, template="{name}.ipynb"):
+    """Get notebook file name in *output_dir* for a given input file
+
+    The ``{name}`` in *template* is replaced by the input file name
+    without extension (other placeholders are kept).
+
+    >>> output_path("docs/r.slope.aspect.html", "notebooks")
+    'notebooks/r.slope.aspect.ipynb'
+    >>> output_path("docs/r.info.html", "notebooks", "{name}.{lang}.ipynb")
+    'notebooks/r.info.{lang}.ipynb'
+    """
+    name = os.path.splitext(os.path.basename(input_))[0]
+    return os.path.join(output_dir, template.replace("{name}", name))
+
+
+def output_collisions(jobs):
+    """Get (input, input, output) for different inputs with the same output
+
+    >>> output_collisions([("a/r.info.html", "n/r.info.ipynb"),
+    ...                    ("b/r.info.html", "n/r.info.ipynb"),
+    ...                    ("a/r.info.html", "n/r.info.ipynb")])
+    [('a/r.info.html', 'b/r.info.html', 'n/r.info.ipynb')]
+    """
+    inputs = {}
+    collisions = []
+    for input_, output in jobs:
+        first = inputs.setdefault(os.path.normpath(output), input_)
+        if os.path.normpath(first) != os.path.normpath(input_):
+            collisions.append((first, input_, output))
+    return collisions
+
+
+# options shared by all conversions in one worker process
+_worker_args = None
+_worker_cache = None
+
+
+def _init_worker(args):
+    """Prepare a worker process for conversions"""
+    global _worker_args, _worker_cache
+    _worker_args = args
+    _worker_cache = cache_from_args(args)
+    # pay the one-time costs (lazy parts of nbformat, regular expressions)
+    # before the first real job
+    convert_languages("", args)
+
+
+def _convert_job(job):
+    """Convert one input-output pair in a worker, return error or None"""
+    input_, output = job
+    try:
+        convert_file(input_, output, _worker_args, cache=_worker_cache)
+    except Exception as error:
+        return input_, "%s: %s" % (error.__class__.__name__, error)
+    return input_, None
+
+
+def convert_many(jobs, args, processes=None):
+    """Convert input-output pairs in a pool of worker processes
+
+    The number of *processes* defaults to the number of CPUs.
+    Returns list of failures as (input file, error message) pairs.
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(jobs)))
+    failures = []
+    if processes == 1:
+        _init_worker(args)
+        results = map(_convert_job, jobs)
+        failures = [(input_, error) for input_, error in results if error]
+        return failures
+    import multiprocessing
+
+    with multiprocessing.Pool(
+        processes, initializer=_init_worker, initargs=(args,)
+    ) as pool:
+        # small chunks keep the workers busy with unevenly sized pages
+        for input_, error in pool.imap_unordered(_convert_job, jobs, chunksize=1):
+            if error:
+                failures.append((input_, error))
+    return failures
+
+
+class PollingWatcher(object):
+    """Detect changed input files by comparing their modification times
+
+    The *paths* are files and directories as for :func:`collect_inputs`.
+    """
+
+    def __init__(self, paths, interval=0.5):
+        self.paths = paths
+        self.interval = interval
+        self._state = self._scan()
+
+    def _scan(self):
+        state = {}
+        for path in collect_inputs(self.paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+        return state
+
+    def changes(self, timeout=None):
+        """Wait for changes and return set of changed (or new) files
+
+        Returns an empty set when nothing changed in *timeout* seconds
+        (None means no timeout).
+        """
+        start = time.time()
+        while True:
+            if timeout is None:
+                time.sleep(self.interval)
+            else:
+                time.sleep(min(self.interval, timeout))
+            state = self._scan()
+            changed = set(
+                path for path, value in state.items() if self._state.get(path) != value
+            )
+            self._state = state
+            if changed or (timeout is not None and time.time() - start >= timeout):
+                return changed
+
+
+class InotifyWatcher(object):
+    """Detect files written or moved to *directories* using Linux inotify
+
+    Raises OSError or AttributeError when inotify is not available.
+    """
+
+    # from sys/inotify.h
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CLOEXEC = 0x80000
+
+    def __init__(self, directories):
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "Cannot initialize inotify")
+        self._directories = {}
+        for directory in directories:
+            descriptor = libc.inotify_add_watch(
+                self._fd,
+                os.fsencode(directory),
+                self.IN_CLOSE_WRITE | self.IN_MOVED_TO,
+            )
+            if descriptor < 0:
+                error = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(error, "Cannot watch directory", directory)
+            self._directories[descriptor] = directory
+
+    def changes(self, timeout=None):
+        """Same as :meth:`PollingWatcher.changes`"""
+        import select
+        import struct
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            # struct inotify_event: wd, mask, cookie, len, name
+            descriptor, _, _, length = struct.unpack_from("iIII", data, offset)
+            offset += 16
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if descriptor in self._directories:
+                changed.add(
+                    os.path.join(self._directories[descriptor], os.fsdecode(name))
+                )
+        return changed
+
+
+def file_watcher(paths):
+    """Get watcher for input *paths*, InotifyWatcher if available"""
+    directories = set()
+    for path in paths:
+        if os.path.isdir(path):
+            directories.add(path)
+        else:
+            directories.add(os.path.dirname(path) or os.curdir)
+    try:
+        return InotifyWatcher(sorted(directories))
+    except (OSError, AttributeError):
+        return PollingWatcher(paths)
+
+
+def watch(args, template, debounce=0.2):
+    """Convert inputs in *args* and then again each time they change
+
+    Only changed files are converted, all in this process, so everything
+    loaded stays ready for the next change. Changes which come less than
+    *debounce* seconds apart are converted together. Conversion time of
+    each file is reported. Runs until interrupted.
+    """
+    _init_worker(args)
+    watcher = file_watcher(args.files)
+    inputs = collect_inputs(args.files)
+    try:
+        while True:
+            for input_ in inputs:
+                start = time.time()
+                _, error = _convert_job(
+                    (input_, output_path(input_, args.output_dir, template))
+                )
+                if error:
+                    sys.stderr.write("%s: %s\n" % (input_, error))
+                else:
+                    sys.stderr.write(
+                        "%s: %.1f ms\n" % (input_, (time.time() - start) * 1000)
+                    )
+            changed = watcher.changes()
+            more = changed
+            while more:
+                # wait until the burst of changes (e.g., editor saving) is over
+                more = watcher.changes(debounce)
+                changed |= more
+            changed = set(os.path.normpath(path) for path in changed)
+            inputs = [
+                input_
+                for input_ in collect_inputs(args.files)
+                if os.path.normpath(input_) in changed and os.path.isfile(input_)
+            ]
+    except KeyboardInterrupt:
+        pass
+
+
+def notebook_text(notebook):
+    """Get notebook as text exactly as written by nbformat.write"""
+    text = nbf.writes(notebook)
+    if not text.endswith("\n"):
+        text += "\n"
+    return text
+
+
+def _convert_request(text, options):
+    """Convert text in a server worker, return notebook texts or error"""
+    try:
+        # options not in the request are the ones the server was started with
+        args = argparse.Namespace(**dict(conversion_options(_worker_args), **options))
+        language_list(args.lang)
+        notebooks = convert_languages(text, args)
+        texts = dict((lang, notebook_text(n)) for lang, n in notebooks.items())
+    except Exception as error:
+        return {"error": "%s: %s" % (error.__class__.__name__, error)}
+    return {"notebooks": texts}
+
+
+def _receive_all(connection):
+    chunks = []
+    for chunk in iter(lambda: connection.recv(64 * 1024), b""):
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def serve(address, args, processes=None):
+    """Convert documents sent to a Unix socket at *address* until interrupted
+
+    Each connection sends a JSON object with the HTML text (``text``)
+    and the conversion options (``options``, see CACHE_KEY_OPTIONS,
+    the missing ones are taken from *args*), then shuts down its writing
+    side. The server replies with a JSON
+    object with the notebook text for each language (``notebooks``) or
+    with an ``error`` message. See :func:`request_conversion`.
+
+    Connections are handled in threads, the conversions are done in
+    a pool of *processes* (default: CPU count) which stay warm
+    between requests, so at most that many run in parallel.
+    """
+    import multiprocessing
+    import signal
+    import socket
+    import socketserver
+
+    if os.path.exists(address):
+        if request_conversion(address, "", args) is not None:
+            raise RuntimeError("Server already running at %s" % address)
+        # left after a server which did not exit cleanly
+        os.remove(address)
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(_receive_all(self.request).decode("utf-8"))
+                response = pool.apply(
+                    _convert_request, (request["text"], request["options"])
+                )
+            except Exception as error:
+                response = {"error": "%s: %s" % (error.__class__.__name__, error)}
+            self.request.sendall(json.dumps(response).encode("utf-8"))
+            self.request.shutdown(socket.SHUT_WR)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    with multiprocessing.Pool(
+        processes, initializer=_init_worker, initargs=(args,)
+    ) as pool, Server(address, Handler) as server:
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(address)
+
+
+def conversion_options(args):
+    """Get options which influence the result as a dictionary"""
+    return dict((name, getattr(args, name, None)) for name in CACHE_KEY_OPTIONS)
+
+
+def request_conversion(address, text, args):
+    """Convert *text* by server at Unix socket *address* (see :func:`serve`)
+
+    Returns the server response as a dictionary or None when no server
+    is running at *address*.
+    """
+    import socket
+
+    request = {"text": text, "options": conversion_options(args)}
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(address)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        connection.sendall(json.dumps(request).encode("utf-8"))
+        connection.shutdown(socket.SHUT_WR)
+        return json.loads(_receive_all(connection).decode("utf-8"))
+    finally:
+        connection.close()
+
+
+def convert_file_with_server(address, input_, output, args):
+    """Convert file using server at *address* like :func:`convert_file`
+
+    Returns False when no server is running at *address*.
+    Raises RuntimeError with the message from the server when
+    the conversion fails.
+    """
+    outputs = language_outputs(output, languages(args))
+    with open(input_, encoding=input_encoding(args)) as f:
+        response = request_conversion(address, f.read(), args)
+    if response is None:
+        return False
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    for lang, filename in outputs.items():
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(response["notebooks"][lang])
+    return True
+
+
+# code executing a notebook in a new process (see run_notebook)
+NOTEBOOK_RUNNER_CODE = """\
+import json
+import sys
+
+sys.path.insert(0, sys.argv[1])
+import gdoc2nb
+
+del sys.path[0]
+gdoc2nb.execute_notebook(sys.argv[2], sys.argv[3], **json.loads(sys.argv[4]))
+"""
+
+# first lines of the session code cells (see start_of_grass_session)
+SESSION_CELL_MARKERS = (
+    "# This is a quick introduction into Jupyter Notebook.",
+    SESSION_START_MARKER,
+    "# default font displays",
+    "# set display modules to render into a file",
+)
+
+
+def cell_source(cell):
+    """Get source of a cell from notebook JSON as a string"""
+    source = cell["source"]
+    if isinstance(source, list):
+        return "".join(source)
+    return source
+
+
+def is_session_cell(source):
+    """Check if the code cell is a part of the GRASS GIS session start"""
+    return any(marker in source for marker in SESSION_CELL_MARKERS)
+
+
+def _captured_outputs(captured):
+    """Get outputs captured by IPython in the notebook format"""
+    import base64
+
+    outputs = []
+    for name, text in (("stdout", captured.stdout), ("stderr", captured.stderr)):
+        if text:
+            outputs.append({"output_type": "stream", "name": name, "text": text})
+    for output in captured.outputs:
+        data = {}
+        for mime_type, value in output.data.items():
+            if isinstance(value, bytes):
+                value = base64.b64encode(value).decode("ascii")
+            data[mime_type] = value
+        outputs.append(
+            {
+                "output_type": "display_data",
+                "data": data,
+                "metadata": output.metadata or {},
+            }
+        )
+    return outputs
+
+
+def _show_outputs(outputs):
+    for output in outputs:
+        if output["output_type"] == "stream":
+            getattr(sys, output["name"]).write(output["text"])
+        elif "text/plain" in output["data"]:
+            print(output["data"]["text/plain"])
+
+
+def execute_notebook(path, result_file, cache_dir=None, cache_size=100, environment=""):
+    """Execute code cells of a notebook in this process
+
+    Cells run with IPython as in Jupyter, so the cell magics and
+    exclamation marks work. The number of executed *cells* and the index
+    of the failed *cell* with the error *message* are written as JSON to
+    *result_file* (see :func:`run_notebook` which runs this in a new
+    process).
+
+    With *cache_dir*, outputs of the executed cells are stored in
+    ExecutionCache (*cache_size* in MB) and the cells up to the first
+    cell not in the cache are not executed, only their outputs are shown.
+    The session cells among them are executed again (quietly) to start
+    the session for the following cells. This expects the files and maps
+    created by the cells which are not executed to be still there.
+    """
+    from IPython.core.interactiveshell import InteractiveShell
+    from IPython.utils.capture import capture_output
+    from traitlets.config import Config
+
+    config = Config()
+    config.HistoryManager.enabled = False
+    config.InteractiveShell.colors = "NoColor"
+    shell = InteractiveShell.instance(config=config)
+    with open(path, encoding="utf-8") as f:
+        notebook = json.load(f)
+    cells = [
+        (index, cell_source(cell))
+        for index, cell in enumerate(notebook["cells"])
+        if cell["cell_type"] == "code"
+    ]
+    result = {"cells": 0, "cached": 0}
+    cache = None
+    keys = [None] * len(cells)
+    cached = []
+    if cache_dir:
+        cache = ExecutionCache(cache_dir, max_size=cache_size * 1024 * 1024)
+        keys = cache.cell_keys([source for _, source in cells], environment)
+        for key in keys:
+            outputs = cache.get(key)
+            if outputs is None:
+                break
+            cached.append(outputs)
+    # nothing needs the session when all cells are cached
+    restore_session = len(cached) < len(cells)
+    for position, ((index, source), key) in enumerate(zip(cells, keys)):
+        if position < len(cached):
+            result["cached"] += 1
+            if restore_session and is_session_cell(source):
+                with capture_output():
+                    execution = shell.run_cell(source)
+            else:
+                execution = None
+            _show_outputs(cached[position])
+        elif cache:
+            with capture_output() as captured:
+                execution = shell.run_cell(source)
+            captured.show()
+            result["cells"] += 1
+            if execution.success:
+                cache.put(key, _captured_outputs(captured))
+        else:
+            execution = shell.run_cell(source)
+            result["cells"] += 1
+        if execution and not execution.success:
+            error = execution.error_before_exec or execution.error_in_exec
+            result["cell"] = index
+            result["message"] = "%s: %s" % (error.__class__.__name__, error)
+            break
+    if cache:
+        cache.evict()
+    sys.stdout.flush()
+    with open(result_file, "w") as f:
+        json.dump(result, f)
+
+
+# directory with the stand-in GRASS GIS executable and grass.script
+FAKE_GRASS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_grass")
+
+# first word of a command line which is a module name
+module_name_pattern = LazyPattern(r"^!?([a-z0-9]+\.[a-z0-9_.]+)(\s|$)")
+
+
+def notebook_modules(notebook):
+    """Get names of modules used as commands (not from Python) in *notebook*"""
+    names = set()
+    for cell in notebook["cells"]:
+        if cell["cell_type"] != "code":
+            continue
+        for line in cell_source(cell).splitlines():
+            match = module_name_pattern.match(line)
+            if match:
+                names.add(match.group(1))
+    return names
+
+
+def _fake_grass_environment(env, notebook, directory):
+    """Put fake grass and the modules from *notebook* on PATH in *env*"""
+    bin_dir = os.path.join(directory, ".fake_grass_bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    executable = os.path.join(FAKE_GRASS_DIR, "grass")
+    for name in notebook_modules(notebook):
+        link = os.path.join(bin_dir, name)
+        # directory can be reused with the execution cache
+        if not os.path.lexists(link):
+            os.symlink(executable, link)
+    env["PATH"] = os.pathsep.join([FAKE_GRASS_DIR, bin_dir, env.get("PATH", "")])
+    env["FAKE_GRASS_LOG"] = os.path.join(directory, "fake_grass.log")
+
+
+def run_notebook(
+    path, timeout=None, work_dir=None, fake_grass=False, cache_dir=None, cache_size=100
+):
+    r"""Execute code cells of a notebook in a new process
+
+    The notebook runs in its own new directory (in *work_dir* if provided,
+    otherwise temporary and removed afterwards), so that files it creates
+    do not collide with other notebooks (see :func:`execute_notebook`).
+    With *fake_grass*, the stand-in GRASS GIS executable (which is only
+    used by notebooks created with the default or path to it in --grass)
+    and modules are used instead of the installed ones.
+    With *cache_dir*, the outputs of cells are cached and the directory
+    of the notebook is kept for the next run (in *work_dir* or in
+    *cache_dir*).
+
+    Returns dictionary with the notebook *path*, *status* (passed, failed,
+    timeout or error), *time* in seconds, captured *output*, and for
+    a failure also index of the failed *cell* and the error *message*.
+
+    Cached outputs are used only in the directory of the same notebook
+    where the files created by the cells are:
+
+    >>> directory = tempfile.mkdtemp()
+    >>> for name, code in [("a", "print(1)"), ("b", "print(open('c.txt').read())")]:
+    ...     notebook = nb.new_notebook()
+    ...     notebook["cells"] = [nb.new_code_cell("%%file c.txt\n50 blue"),
+    ...                          nb.new_code_cell(code)]
+    ...     with open(os.path.join(directory, name + ".ipynb"), "w") as f:
+    ...         nbf.write(notebook, f)
+    >>> cache_dir = os.path.join(directory, "cache")
+    >>> [run_notebook(os.path.join(directory, name + ".ipynb"),
+    ...               cache_dir=cache_dir)["status"] for name in "ab"]
+    ['passed', 'passed']
+    """
+    import shutil
+    import signal
+    import subprocess
+
+    result = {"path": path, "status": "error", "time": 0.0, "output": ""}
+    keep_directory = work_dir is not None
+    if work_dir:
+        # the notebook runs in a different current directory
+        work_dir = os.path.abspath(work_dir)
+    if cache_dir:
+        cache_dir = os.path.abspath(cache_dir)
+        import hashlib
+
+        # the same directory for each run of the notebook
+        name = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:12]
+        name += "-" + os.path.splitext(os.path.basename(path))[0]
+        directory = os.path.join(work_dir or os.path.join(cache_dir, "work"), name)
+        os.makedirs(directory, exist_ok=True)
+        keep_directory = True
+    else:
+        directory = tempfile.mkdtemp(prefix="gdoc2nb-run-", dir=work_dir)
+    options = {"cache_dir": cache_dir, "cache_size": cache_size}
+    # outputs are replayed only where the files created by the cells are
+    options["environment"] = "%s\0%s" % ("fake_grass" if fake_grass else "", directory)
+    try:
+        with open(path, encoding="utf-8") as f:
+            notebook = json.load(f)
+        env = os.environ.copy()
+        env["IPYTHONDIR"] = os.path.join(directory, ".ipython")
+        env["MPLBACKEND"] = "Agg"
+        if fake_grass:
+            _fake_grass_environment(env, notebook, directory)
+        result_file = os.path.join(directory, ".result.json")
+        command = [
+            sys.executable,
+            "-c",
+            NOTEBOOK_RUNNER_CODE,
+            os.path.dirname(os.path.abspath(__file__)),
+            os.path.abspath(path),
+            result_file,
+            json.dumps(options),
+        ]
+        start = time.perf_counter()
+        # own process group, so that the subprocesses of cells end too
+        process = subprocess.Popen(
+            command,
+            cwd=directory,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        try:
+            output, _ = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            output, _ = process.communicate()
+            result["status"] = "timeout"
+            result["message"] = "Timeout after %s s" % timeout
+        result["time"] = time.perf_counter() - start
+        result["output"] = output.decode("utf-8", "replace")
+        if result["status"] == "timeout":
+            return result
+        if not os.path.exists(result_file):
+            result["message"] = "Runner exited with code %d" % process.returncode
+            return result
+        with open(result_file) as f:
+            execution = json.load(f)
+        result["cells"] = execution["cells"]
+        result["cached"] = execution["cached"]
+        if "message" in execution:
+            result["status"] = "failed"
+            result["cell"] = execution["cell"]
+            result["message"] = execution["message"]
+        else:
+            result["status"] = "passed"
+    except (OSError, ValueError) as error:
+        result["message"] = "%s: %s" % (error.__class__.__name__, error)
+    finally:
+        if not keep_directory:
+            shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+
+def run_notebooks(paths, jobs=None, **kwargs):
+    """Execute notebooks in parallel, generate results in the order of *paths*
+
+    The number of parallel *jobs* defaults to the number of CPUs.
+    See :func:`run_notebook` for the other parameters and the results.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(paths)))
+    run = functools.partial(run_notebook, **kwargs)
+    # the work is done by the processes, threads only wait for them
+    with ThreadPool(jobs) as pool:
+        yield from pool.imap(run, paths)
+
+
+def junit_report(results, name="gdoc2nb"):
+    """Create JUnit-style XML report (as ElementTree) from notebook results
+
+    >>> import xml.etree.ElementTree as ET
+    >>> results = [
+    ...     {"path": "a.ipynb", "status": "passed", "time": 1.5, "output": ""},
+    ...     {"path": "b.ipynb", "status": "failed", "time": 0.5, "output": "x",
+    ...      "cell": 3, "message": "NameError: name 'x' is not defined"},
+    ... ]
+    >>> suite = junit_report(results).getroot()
+    >>> suite.get("tests"), suite.get("failures"), suite.get("time")
+    ('2', '1', '2.000')
+    >>> print(ET.tostring(suite[1], encoding="unicode"))
+    <testcase classname="gdoc2nb" name="b.ipynb" time="0.500"><failure \
+message="cell 3: NameError: name 'x' is not defined" type="failed" /><system-out>\
+x</system-out></testcase>
+    """
+    import xml.etree.ElementTree as ET
+
+    suite = ET.Element("testsuite")
+    suite.set("errors", "0")
+    suite.set("failures", "0")
+    suite.set("name", name)
+    suite.set("tests", str(len(results)))
+    suite.set("time", "%.3f" % sum(result["time"] for result in results))
+    counts = {"failures": 0, "errors": 0}
+    for result in results:
+        case = ET.SubElement(suite, "testcase")
+        case.set("classname", name)
+        case.set("name", result["path"])
+        case.set("time", "%.3f" % result["time"])
+        if result["status"] == "passed":
+            continue
+        message = result.get("message", "")
+        if result["status"] == "failed":
+            counts["failures"] += 1
+            problem = ET.SubElement(case, "failure")
+            message = "cell %d: %s" % (result["cell"], message)
+        else:
+            counts["errors"] += 1
+            problem = ET.SubElement(case, "error")
+        problem.set("message", message)
+        problem.set("type", result["status"])
+        if result["output"]:
+            ET.SubElement(case, "system-out").text = result["output"]
+    for key, count in counts.items():
+        suite.set(key, str(count))
+    return ET.ElementTree(suite)
+
+
+def run_main(argv):
+    """Command line interface of the run subcommand"""
+    parser = argparse.ArgumentParser(
+        prog="%s run" % os.path.basename(sys.argv[0]),
+        description="Execute notebooks (created by the conversion) as tests.",
+    )
+    parser.add_argument(
+        "files",
+        metavar="FILE",
+        nargs="+",
+        help="Notebooks or directories with notebooks to execute",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="jobs",
+        type=int,
+        help="Number of notebooks executed in parallel (default: CPU count)",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        type=float,
+        default=600,
+        help="Maximum time for one notebook in seconds",
+    )
+    parser.add_argument(
+        "--junit",
+        dest="junit",
+        metavar="FILE",
+        help="Write results as JUnit-style XML report to this file",
+    )
+    parser.add_argument(
+        "--fake-grass",
+        dest="fake_grass",
+        action="store_true",
+        help="Use a stand-in GRASS GIS executable, modules and grass.script"
+        " (for notebooks converted with the default --grass)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        help="Keep directories in which the notebooks run in this directory"
+        " (temporary directories are used and removed otherwise)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Directory for caching outputs of cells, so that cells before"
+        " the first changed cell do not run again (no caching by default)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        type=int,
+        default=100,
+        help="Maximum size of the cache in MB",
+    )
+    args = parser.parse_args(argv)
+
+    paths = collect_inputs(args.files, extensions=(".ipynb",))
+    if args.work_dir and not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+    results = []
+    for result in run_notebooks(
+        paths,
+        jobs=args.jobs,
+        timeout=args.timeout,
+        work_dir=args.work_dir,
+        fake_grass=args.fake_grass,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+    ):
+        results.append(result)
+        cached = ""
+        if result.get("cached"):
+            cached = ", %d cells cached" % result["cached"]
+        print(
+            "%s: %s (%.2f s%s)"
+            % (result["path"], result["status"], result["time"], cached)
+        )
+        if result["status"] != "passed":
+            if "cell" in result:
+                sys.stderr.write("%s: cell %d: " % (result["path"], result["cell"]))
+            else:
+                sys.stderr.write("%s: " % result["path"])
+            sys.stderr.write("%s\n" % result["message"])
+    if args.junit:
+        junit_report(results).write(args.junit, encoding="utf-8", xml_declaration=True)
+    passed = sum(1 for result in results if result["status"] == "passed")
+    sys.stderr.write("Passed %d of %d notebooks\n" % (passed, len(results)))
+    return 0 if passed == len(results) else 1
 
 
 def main():
+    if sys.argv[1:2] == ["run"]:
+        return run_main(sys.argv[2:])
     parser = argparse.ArgumentParser(
         description="Convert HTML documentation to Jupyter Notebook."
+        " Use the run subcommand to execute the notebooks."
     )
-    parser.add_argument("files", metavar="FILE", nargs="+", help="Files to convert")
+    parser.add_argument("files", metavar="FILE", nargs="*", help="Files to convert")
     parser.add_argument(
         "--lang",
         dest="lang",
         default="python",
-        choices=["python", "python2", "bash", "bash-cells", "pure-bash"],
-        help="GRASS GIS executable",
+        type=language_list,
+        help="Output language or comma-separated list of languages (%s);"
+        " the output file name then needs {lang} placeholder" % ", ".join(LANGUAGES),
     )
     # TODO: allow no provided
     # TODO: allow mapset as full path
     parser.add_argument(
-        "--grass", dest="grass", default="grass", help="GRASS GIS executable"
-    )
-    parser.add_argument(
-        "--gisdbase", dest="gisdbase", required=True, help="GRASS GIS Database"
-    )
-    parser.add_argument(
-        "--location", dest="location", required=True, help="GRASS GIS Location"
+        "--encoding",
+        dest="encoding",
+        default=DEFAULT_ENCODING,
+        help="Encoding of input files",
     )
     parser.add_argument(
-        "--mapset", dest="mapset", required=True, help="GRASS GIS Mapset"
+        "--grass", dest="grass", default="grass", help="GRASS GIS executable"
     )
+    parser.add_argument("--gisdbase", dest="gisdbase", help="GRASS GIS Database")
+    parser.add_argument("--location", dest="location", help="GRASS GIS Location")
+    parser.add_argument("--mapset", dest="mapset", help="GRASS GIS Mapset")
     parser.add_argument(
         "--code-start",
         dest="code_start",
-        default=r"^<pre><code>$",
+        default=DEFAULT_CODE_START,
         help="Starting tags of a code block (regular expression)",
     )
     parser.add_argument(
         "--code-end",
         dest="code_end",
-        default=r"^</code></pre>$",
+        default=DEFAULT_CODE_END,
         help="Ending tags of a code block (regular expression)",
     )
     parser.add_argument(
@@ -1109,97 +4431,262 @@ def main():
         action="store_true",
         help="Place a GRASS GIS session code after first text cell",
     )
+    parser.add_argument(
+        "--module-index",
+        dest="module_index",
+        metavar="FILE",
+        help="Module index for translating commands to Python"
+        " (see --build-module-index)",
+    )
+    parser.add_argument(
+        "--build-module-index",
+        dest="build_module_index",
+        metavar="DIR",
+        help="Create module index (--module-index) from GRASS GIS module"
+        " interface descriptions (XML files) in a directory",
+    )
+    parser.add_argument(
+        "--dependencies",
+        dest="dependencies",
+        action="store_true",
+        help="Add maps used and created by code cells and dependencies between"
+        " the cells to notebook metadata and to output name with"
+        " .dependencies.json suffix",
+    )
+    parser.add_argument(
+        "--depends-on-cell",
+        dest="depends_on_cell",
+        metavar="INDEX",
+        type=int,
+        help="List cells depending on the cell with this index in FILEs"
+        " (notebooks or directories, converted with --dependencies)",
+    )
+    parser.add_argument(
+        "--depends-on-map",
+        dest="depends_on_map",
+        metavar="NAME",
+        help="List cells creating or using the map and cells depending on them"
+        " in FILEs"
+        " (notebooks or directories, converted with --dependencies)",
+    )
+    parser.add_argument(
+        "--format",
+        dest="format",
+        choices=("notebook", "script"),
+        default="notebook",
+        help="Output format: notebook or Python (.py) or Bash (.sh) script"
+        " according to the language (scripts are written as a stream"
+        " and not cached)",
+    )
+    parser.add_argument(
+        "--stream-writer",
+        dest="stream_writer",
+        action="store_true",
+        help="Write notebook cell by cell instead of creating it in memory"
+        " (skips validation of the whole notebook)",
+    )
+    parser.add_argument(
+        "--block-jobs",
+        dest="block_jobs",
+        type=int,
+        help="Convert blocks of each document in this number of parallel"
+        " processes (for very large documents, the result is the same)",
+    )
+    parser.add_argument(
+        "--output-dir",
+        dest="output_dir",
+        help="Convert all FILEs (or HTML files in FILE directories) into this"
+        " directory (batch mode)",
+    )
+    parser.add_argument(
+        "--output-template",
+        dest="output_template",
+        help="Output file name template in batch mode with {name} (input file"
+        " name without extension), {lang} and {ext} (ipynb, py or sh) placeholders"
+        " (default: {name}.{ext} or {name}.{lang}.{ext} for more languages)",
+    )
+    parser.add_argument(
+        "--watch",
+        dest="watch",
+        action="store_true",
+        help="Keep running in batch mode and convert files again when they change",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="jobs",
+        type=int,
+        help="Number of parallel conversions in batch mode (default: CPU count)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        help="Directory for caching converted notebooks (no caching by default)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        dest="cache_size",
+        type=int,
+        default=100,
+        help="Maximum size of the cache in MB",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        dest="clear_cache",
+        action="store_true",
+        help="Remove all cached notebooks before conversion",
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="Write time of conversion stages and other counters for each input"
+        " as JSON to output name with .profile.json suffix",
+    )
+    parser.add_argument(
+        "--cprofile",
+        dest="cprofile",
+        action="store_true",
+        help="Write Python profiler (cProfile) data for each input"
+        " to output name with .prof suffix",
+    )
+    parser.add_argument(
+        "--serve",
+        dest="serve",
+        metavar="SOCKET",
+        help="Run as a server converting documents sent to this Unix socket"
+        " (the number of parallel conversions is given by --jobs)",
+    )
+    parser.add_argument(
+        "--server",
+        dest="server",
+        metavar="SOCKET",
+        help="Convert using a server at this Unix socket if it is running",
+    )
+    parser.add_argument(
+        "--version", action="version", version="%(prog)s " + __version__
+    )
     args = parser.parse_args()
-    input_ = args.files[0]
-    output = args.files[1]
-
-    lang = args.lang
-
-    processor = Processor()
-    splitter = Splitter(processor, code_tags=(args.code_start, args.code_end))
-    splitter.split(open(input_).read())
-    processor.finish()
-
-    notebook = nb.new_notebook()
-    if lang == "python2":
-        notebook["metadata"]["kernelspec"] = {
-            "display_name": "Python 2",
-            "language": "python",
-            "name": "python2",
-        }
-    else:
-        notebook["metadata"]["kernelspec"] = {
-            "display_name": "Python 3",
-            "language": "python",
-            "name": "python3",
-        }
 
-    filenames = []
-
-    add_session_start = False
-    first_text_cell = True
-
-    for block in processor.blocks:
-        if add_session_start:
-            add_session_start = False
-            cells = start_of_grass_session(
-                "",
-                grass=args.grass,
-                gisdbase=args.gisdbase,
-                location=args.location,
-                mapset=args.mapset,
-                python2=lang == "python2",
-            )
-            for cell in cells:
-                notebook["cells"].append(nb.new_code_cell(cell))
-        if block["block_type"] == "code":
-            if lang == "python" or lang == "python2":
-                c = HTMLBashCodeToPythonNotebookConverter(
-                    notebook,
-                    grass=args.grass,
-                    gisdbase=args.gisdbase,
-                    location=args.location,
-                    mapset=args.mapset,
-                    python2=lang == "python2",
-                )
-            if lang in ("bash", "bash-cells", "pure-bash"):
-                if lang == "bash":
-                    syntax = "!"
-                elif lang == "bash-cells":
-                    syntax = "cell"
-                elif lang == "pure-bash":
-                    syntax = "pure"
-                c = HTMLBashCodeToNotebookConverter(
-                    notebook,
-                    syntax=syntax,
-                    grass=args.grass,
-                    gisdbase=args.gisdbase,
-                    location=args.location,
-                    mapset=args.mapset,
-                )
-            c.feed("\n".join(block["content"]))
-            c.finish()
-        elif block["block_type"] == "file_content":
-            c = HTMLFileContentToPythonNotebookConverter(
-                notebook, filename=block["attrs"]["filename"]
-            )
-            c.feed("\n".join(block["content"]))
-            c.finish()
-        elif block["block_type"] == "text":
-            c = HTMLToMarkdownNotebookConverter(notebook)
-            c.feed("\n".join(block["content"]))
-            c.finish()
-            filenames.extend(c.download_files)
-            if first_text_cell and args.session_after_text:
-                add_session_start = True
-            first_text_cell = False
+    if args.build_module_index:
+        if not args.module_index:
+            parser.error("--build-module-index requires --module-index")
+        index = build_module_index(args.build_module_index)
+        write_module_index(index, args.module_index)
+        sys.stderr.write("Module index with %d modules created\n" % len(index))
+        return 0
+    if args.depends_on_cell is not None or args.depends_on_map:
+        results = query_dependencies(
+            args.files, cell=args.depends_on_cell, map_name=args.depends_on_map
+        )
+        for path, index, cell_id in results:
+            print("%s:%d %s" % (path, index, cell_id))
+        return 0
+    if args.serve:
+        try:
+            serve(args.serve, args, processes=args.jobs)
+        except RuntimeError as error:
+            sys.stderr.write("%s\n" % error)
+            return 1
+        return 0
+    if not args.files:
+        parser.error("the following arguments are required: FILE")
+    for name in ("gisdbase", "location", "mapset"):
+        if getattr(args, name) is None:
+            parser.error("the following arguments are required: --%s" % name)
+    if args.format == "script" and args.dependencies:
+        parser.error("--dependencies can be used only with notebooks")
+
+    if args.clear_cache:
+        if not args.cache_dir:
+            parser.error("--clear-cache requires --cache-dir")
+        cache_from_args(args).clear()
+
+    if not args.output_dir:
+        if args.watch:
+            parser.error("--watch requires --output-dir")
+        if len(args.files) != 2:
+            parser.error("exactly one input and one output file needed")
+        if len(languages(args)) > 1 and "{lang}" not in args.files[1]:
+            parser.error("output file name needs {lang} for more than one language")
+        # the server creates only notebooks
+        if args.server and args.format == "notebook":
+            try:
+                if convert_file_with_server(
+                    args.server, args.files[0], args.files[1], args
+                ):
+                    return 0
+            except RuntimeError as error:
+                sys.stderr.write("%s: %s\n" % (args.files[0], error))
+                return 1
+        convert_file(args.files[0], args.files[1], args, cache=cache_from_args(args))
+        return 0
+
+    inputs = collect_inputs(args.files)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    template = args.output_template
+    if not template:
+        if len(languages(args)) > 1:
+            template = "{name}.{lang}.{ext}"
+        else:
+            template = "{name}.{ext}"
+    elif len(languages(args)) > 1 and "{lang}" not in template:
+        parser.error("output template needs {lang} for more than one language")
+    jobs = [
+        (input_, output_path(input_, args.output_dir, template)) for input_ in inputs
+    ]
+    for first, second, output in output_collisions(jobs):
+        parser.error(
+            "%s and %s would be both converted to %s"
+            " (convert them into separate output directories)" % (first, second, output)
+        )
+    if args.watch:
+        watch(args, template)
+        return 0
+    failures = convert_many(jobs, args, processes=args.jobs)
+    for input_, error in failures:
+        sys.stderr.write("%s: %s\n" % (input_, error))
+    sys.stderr.write(
+        "Converted %d of %d files\n" % (len(jobs) - len(failures), len(jobs))
+    )
+    return 1 if failures else 0
+
+
+# modules imported only when needed (not for each start of the tool)
+DEFERRED_MODULES = (
+    "IPython",
+    "multiprocessing",
+    "nbformat",
+    "nbformat.v4",
+    "socket",
+    "subprocess",
+    "xml.etree.ElementTree",
+)
+
 
-    if filenames:
-        add_file_downloads(notebook, filenames, lang == "python2")
-    finish_session(notebook)
+def startup_modules():
+    """Get names of modules imported with this module
 
-    with open(output, "w") as f:
-        nbf.write(notebook, f)
+    Runs a new interpreter, so that modules imported by other code
+    are not included. The import time is checked against a target
+    by ``benchmark.py --startup-only --baseline benchmark_baseline.json``.
+
+    >>> sorted(set(DEFERRED_MODULES) & set(startup_modules()))
+    []
+    """
+    import subprocess
+
+    code = "import sys; import gdoc2nb; print(' '.join(sys.modules))"
+    directory = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=directory,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return result.stdout.split()
 
 
 def test():
@@ -1211,4 +4698,4 @@ def test():
 if __name__ == "__main__":
     if len(sys.argv) == 2 and sys.argv[1] == "--doctest":
         sys.exit(test())
-    main()
+    sys.exit(main())